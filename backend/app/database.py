@@ -1,18 +1,44 @@
 from sqlalchemy import create_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool, StaticPool
 import os
 from dotenv import load_dotenv
 
 load_dotenv()
 
-from sqlalchemy import create_engine
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
-import os
-from dotenv import load_dotenv
+def build_engine(database_url: str):
+    """Create the SQLAlchemy engine with pool settings tuned for concurrent API load"""
+    echo = os.getenv("DB_ECHO", "false").lower() == "true"
+    # Compiled SQL per statement shape; the default of 500 is shared by every query
+    # in the app, so evictions force recompiles on the hot paths
+    query_cache_size = int(os.getenv("DB_QUERY_CACHE_SIZE", "1200"))
 
-load_dotenv()
+    if database_url.startswith("sqlite"):
+        # sqlite3 keeps prepared statements per connection (128 by default)
+        connect_args = {"check_same_thread": False, "cached_statements": 512}
+        # In-memory SQLite only exists on a single connection, so share it
+        if database_url in ("sqlite://", "sqlite:///:memory:"):
+            return create_engine(database_url, echo=echo, connect_args=connect_args,
+                                 query_cache_size=query_cache_size, poolclass=StaticPool)
+        return create_engine(database_url, echo=echo, connect_args=connect_args, query_cache_size=query_cache_size)
+
+    # PgBouncer in transaction mode already pools server connections; keeping a
+    # second pool (and pre-pinging through it) only adds round trips
+    if os.getenv("DB_USE_PGBOUNCER", "false").lower() == "true":
+        return create_engine(database_url, echo=echo, query_cache_size=query_cache_size,
+                             poolclass=NullPool, pool_pre_ping=False)
+
+    return create_engine(
+        database_url,
+        echo=echo,
+        query_cache_size=query_cache_size,
+        pool_size=int(os.getenv("DB_POOL_SIZE", "25")),
+        max_overflow=int(os.getenv("DB_MAX_OVERFLOW", "25")),
+        pool_timeout=int(os.getenv("DB_POOL_TIMEOUT", "30")),
+        pool_recycle=int(os.getenv("DB_POOL_RECYCLE", "1800")),
+        pool_pre_ping=True,
+    )
 
 # Database URL from environment variables
 DATABASE_URL = os.getenv("DATABASE_URL")
@@ -25,56 +51,24 @@ else:
     print(f"Using database: {DATABASE_URL.split('@')[1] if '@' in DATABASE_URL else 'SQLite'}")
 
 # Create SQLAlchemy engine
-try:
-    if DATABASE_URL.startswith("postgresql"):
-        engine = create_engine(DATABASE_URL, echo=True)
-        # Test the connection
-        with engine.connect() as conn:
-            pass
-    else:
-        engine = create_engine(DATABASE_URL, echo=True, connect_args={"check_same_thread": False})
-except Exception as e:
-    print(f"Database connection failed: {e}")
-    print("Falling back to SQLite for development")
-    DATABASE_URL = "sqlite:///./bus_tracking.db"
-    engine = create_engine(DATABASE_URL, echo=True, connect_args={"check_same_thread": False})
-
-# Create SessionLocal class
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-
-# Create Base class
-Base = declarative_base()
+engine = build_engine(DATABASE_URL)
 
-# Dependency to get database session
-def get_db():
-    db = SessionLocal()
+# Optionally verify connectivity at startup. Kept opt-in so that every
+# worker fork does not open a throwaway connection on import.
+if os.getenv("DB_STARTUP_PROBE") and not DATABASE_URL.startswith("sqlite"):
     try:
-        yield db
-    finally:
-        db.close()
-DATABASE_URL = os.getenv("DATABASE_URL")
-
-# If no DATABASE_URL is set or PostgreSQL fails, use SQLite for development
-if not DATABASE_URL:
-    DATABASE_URL = "sqlite:///./bus_tracking.db"
-    print("Using SQLite database for development")
-else:
-    print(f"Using database: {DATABASE_URL}")
-
-# Create SQLAlchemy engine
-try:
-    if DATABASE_URL.startswith("sqlite"):
-        engine = create_engine(DATABASE_URL, echo=True, connect_args={"check_same_thread": False})
-    else:
-        engine = create_engine(DATABASE_URL, echo=True)
-except Exception as e:
-    print(f"Failed to connect to PostgreSQL: {e}")
-    print("Falling back to SQLite for development")
-    DATABASE_URL = "sqlite:///./bus_tracking.db"
-    engine = create_engine(DATABASE_URL, echo=True, connect_args={"check_same_thread": False})
+        with engine.connect() as conn:
+            pass
+    except Exception as e:
+        print(f"Database connection failed: {e}")
+        print("Falling back to SQLite for development")
+        DATABASE_URL = "sqlite:///./bus_tracking.db"
+        engine = build_engine(DATABASE_URL)
 
 # Create SessionLocal class
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Objects stay usable after commit without a reload query per attribute; handlers
+# that need fresh state after a commit already call db.refresh()
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
 
 # Create Base class
 Base = declarative_base()
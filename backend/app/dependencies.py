@@ -1,5 +1,7 @@
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from typing import Optional
+from typing_extensions import Annotated
 from fastapi import Depends, HTTPException, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from jose import JWTError, jwt
@@ -8,20 +10,58 @@ from sqlalchemy.orm import Session
 from .database import get_db
 from .models.user import User
 from .schemas import TokenData
+import hashlib
 import os
+import secrets
+import threading
+import time
 
 # Security setup
 SECRET_KEY = os.getenv("SECRET_KEY", "fallback-secret-key")
 ALGORITHM = os.getenv("ALGORITHM", "HS256")
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "30"))
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Lower BCRYPT_ROUNDS in dev/test to keep hashing from dominating request time
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+PASSWORD_CACHE_TTL_SECONDS = 60
+PASSWORD_CACHE_MAX_ENTRIES = 1024
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
 security = HTTPBearer()
 
+# Recent bcrypt verification results keyed by (user_id, keyed digest of the
+# password, stored hash). The digest key is random per process so cached
+# entries cannot be used to brute-force passwords offline.
+_password_cache_key = secrets.token_bytes(32)
+_password_cache: "OrderedDict[tuple, tuple]" = OrderedDict()
+_password_cache_lock = threading.Lock()
+
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     """Verify a password against its hash"""
     return pwd_context.verify(plain_password, hashed_password)
 
+def verify_password_cached(user_id: int, plain_password: str, hashed_password: str) -> bool:
+    """Verify a password, reusing the result of an identical check from the last minute"""
+    digest = hashlib.blake2b(plain_password.encode(), key=_password_cache_key, digest_size=16).digest()
+    # The stored hash is part of the key, so a password change never hits an old entry
+    key = (user_id, digest, hashed_password)
+    now = time.monotonic()
+
+    with _password_cache_lock:
+        cached = _password_cache.get(key)
+        if cached and cached[0] > now:
+            return cached[1]
+
+    result = verify_password(plain_password, hashed_password)
+
+    with _password_cache_lock:
+        _password_cache[key] = (now + PASSWORD_CACHE_TTL_SECONDS, result)
+        _password_cache.move_to_end(key)
+        while len(_password_cache) > PASSWORD_CACHE_MAX_ENTRIES:
+            _password_cache.popitem(last=False)
+
+    return result
+
 def get_password_hash(password: str) -> str:
     """Hash a password"""
     return pwd_context.hash(password)
@@ -51,11 +91,15 @@ def authenticate_user(db: Session, email: str, password: str):
         return False
     return user
 
-async def get_current_user(
+def get_current_user(
     credentials: HTTPAuthorizationCredentials = Depends(security),
     db: Session = Depends(get_db)
 ):
-    """Get current authenticated user from JWT token"""
+    """
+    Get current authenticated user from JWT token
+    Plain def: the user lookup blocks, so FastAPI runs it in the threadpool rather than
+    on the event loop. The role checks below do no I/O and stay async.
+    """
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -100,7 +144,7 @@ async def get_driver_user(current_user: User = Depends(get_current_active_user))
         )
     return current_user
 
-async def get_current_driver(
+def get_current_driver(
     current_user: User = Depends(get_driver_user),
     db: Session = Depends(get_db)
 ):
@@ -113,3 +157,9 @@ async def get_current_driver(
             detail="Driver profile not found"
         )
     return driver
+
+# Shorthand for handler signatures. FastAPI resolves get_db once per request, so the
+# handler and get_current_user share one session and one pooled connection.
+DbSession = Annotated[Session, Depends(get_db)]
+CurrentUser = Annotated[User, Depends(get_current_user)]
+AdminUser = Annotated[User, Depends(get_admin_user)]
@@ -1,9 +1,11 @@
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Text, Float, Time
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Text, Float, Time, Index, Enum as SAEnum
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from ..database import Base
 
+USER_ROLES = ("admin", "driver", "passenger")
+
 class User(Base):
     __tablename__ = "users"
 
@@ -12,7 +14,7 @@ class User(Base):
     full_name = Column(String, nullable=False)
     phone = Column(String, nullable=True)
     hashed_password = Column(String, nullable=False)
-    role = Column(String, nullable=False)  # admin, driver, passenger
+    role = Column(SAEnum(*USER_ROLES, name="user_role", create_constraint=True), nullable=False)  # admin, driver, passenger
     is_active = Column(Boolean, default=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
@@ -20,6 +22,11 @@ class User(Base):
     # Relationships
     driver_profile = relationship("Driver", back_populates="user", uselist=False)
 
+    __table_args__ = (
+        # Role listings, optionally narrowed to active users; also serves role-only filters
+        Index("ix_users_role_active", "role", "is_active"),
+    )
+
 class Driver(Base):
     __tablename__ = "drivers"
 
@@ -35,6 +42,10 @@ class Driver(Base):
     # Relationships
     user = relationship("User", back_populates="driver_profile")
 
+    __table_args__ = (
+        Index("ix_drivers_is_active", "is_active"),
+    )
+
 class Bus(Base):
     __tablename__ = "buses"
 
@@ -69,7 +80,12 @@ class Route(Base):
     # Relationships
     bus = relationship("Bus", back_populates="routes")
     driver = relationship("Driver", foreign_keys=[driver_id])
-    stops = relationship("RouteStop", back_populates="route", cascade="all, delete-orphan")
+    stops = relationship("RouteStop", back_populates="route", cascade="all, delete-orphan", order_by="RouteStop.stop_order")
+
+    __table_args__ = (
+        Index("ix_routes_driver_active", "driver_id", "is_active"),
+        Index("ix_routes_bus_active", "bus_id", "is_active"),
+    )
 
 class RouteStop(Base):
     __tablename__ = "route_stops"
@@ -86,6 +102,10 @@ class RouteStop(Base):
     # Relationships
     route = relationship("Route", back_populates="stops")
 
+    __table_args__ = (
+        Index("ix_routestop_route_order", "route_id", "stop_order"),
+    )
+
 class GPSTracking(Base):
     __tablename__ = "gps_tracking"
 
@@ -101,3 +121,35 @@ class GPSTracking(Base):
     driver = relationship("Driver", foreign_keys=[driver_id])
     bus = relationship("Bus", foreign_keys=[bus_id])
     route = relationship("Route", foreign_keys=[route_id])
+
+    __table_args__ = (
+        # Matches the "latest fix per bus" ORDER BY timestamp DESC lookups, so they
+        # read the newest row first without a sort step
+        Index("ix_gps_bus_ts_desc", bus_id, timestamp.desc()),
+        # Latest fix per (route, bus) for the find-route lookup: seeks on route_id and
+        # reads each partition newest first, covering the window query without a sort
+        Index("ix_gps_route_bus_ts_desc", route_id, bus_id, timestamp.desc()),
+        Index("ix_gps_driver_ts", "driver_id", "timestamp"),
+    )
+
+class Ticket(Base):
+    __tablename__ = "tickets"
+
+    id = Column(String(36), primary_key=True)  # UUID string
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    bus_id = Column(Integer, nullable=False)  # no FK: tickets outlive deleted buses, bus_number is kept
+    bus_number = Column(String, nullable=False)
+    route_name = Column(String, nullable=False)
+    source_stop = Column(String, nullable=False)
+    destination_stop = Column(String, nullable=False)
+    qr_code = Column(String, nullable=False)
+    one_time_code = Column(String, nullable=False)
+    status = Column(String, nullable=False, default="active")  # active, used; "expired" is derived from expires_at
+    expires_at = Column(DateTime, nullable=False)
+    created_at = Column(DateTime, nullable=False)
+
+    __table_args__ = (
+        # "My tickets" lookups by owner, with expiry available from the index
+        Index("ix_tickets_user_expires", "user_id", "expires_at"),
+        Index("ix_tickets_expires", "expires_at"),
+    )
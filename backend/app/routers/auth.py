@@ -1,24 +1,36 @@
-from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File
+from fastapi import APIRouter, Depends, HTTPException, Response, status, UploadFile, File
 from fastapi.security import HTTPBearer
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
-from typing import List
+from typing import List, Optional
 import base64
 import os
 
 from ..database import get_db
-from ..dependencies import get_current_user, get_admin_user, get_current_active_user
+from ..dependencies import (
+    get_current_user, get_admin_user, get_current_active_user,
+    verify_password_cached, get_password_hash, create_access_token
+)
 from ..schemas import (
-    LoginRequest, Token, UserCreate, DriverCreate, FacialLoginRequest, 
+    LoginRequest, Token, UserCreate, DriverCreate, CombinedDriverCreate, FacialLoginRequest, 
     User, Driver, FaceUpload, ChangePassword, UserRole, FaceImageUpload,
     FaceLoginRequest, FaceLoginResponse, FaceQualityResponse
 )
 from ..services.auth_service import auth_service
 from ..services.mock_face_recognition_service import face_service
-from ..models.user import Driver as DriverModel
+from ..models.user import User as UserModel, Driver as DriverModel, USER_ROLES
 
 router = APIRouter(prefix="/auth", tags=["authentication"])
 security = HTTPBearer()
 
+def decode_face_image(image_data: str) -> bytes:
+    """Decode a base64 face image, rejecting malformed input before any processing"""
+    try:
+        return base64.b64decode(image_data, validate=True)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid base64 image data")
+
 @router.post("/register", response_model=User)
 async def register_user(
     user: UserCreate,
@@ -26,16 +38,15 @@ async def register_user(
     current_user: User = Depends(get_admin_user)  # Only admin can create users
 ):
     """Register a new user (admin only)"""
-    # Check if user already exists
-    existing_user = auth_service.get_users_by_role(db, user.role.value)
-    for existing in existing_user:
-        if existing.email == user.email:
-            raise HTTPException(
-                status_code=400,
-                detail="Email already registered"
-            )
-    
-    return auth_service.create_user(db, user)
+    # The unique index on users.email rejects duplicates, no pre-check needed
+    try:
+        return auth_service.create_user(db, user)
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(
+            status_code=409,
+            detail="Email already registered"
+        )
 
 @router.post("/register/passenger", response_model=User)
 async def register_passenger(
@@ -46,62 +57,52 @@ async def register_passenger(
     # Force role to be passenger
     user.role = UserRole.PASSENGER
     
-    # Check if email already exists (across all users)
-    from ..models.user import User as UserModel
-    existing_user = db.query(UserModel).filter(UserModel.email == user.email).first()
-    if existing_user:
+    # The unique index on users.email rejects duplicates, no pre-check needed
+    try:
+        return auth_service.create_user(db, user)
+    except IntegrityError:
+        db.rollback()
         raise HTTPException(
-            status_code=400,
+            status_code=409,
             detail="Email already registered"
         )
-    
-    return auth_service.create_user(db, user)
 
 @router.post("/register/driver", response_model=Driver)
 async def register_driver(
-    combined_data: dict,
+    combined_data: CombinedDriverCreate,
     db: Session = Depends(get_db),
     current_user: User = Depends(get_admin_user)  # Only admin can create drivers
 ):
     """Register a new driver (admin only)"""
-    # Extract user and driver data from combined request
+    # Split the combined request into user and driver data
     user_data = UserCreate(
-        email=combined_data["email"],
-        full_name=combined_data["full_name"],
-        phone=combined_data.get("phone"),
-        password=combined_data["password"],
+        **combined_data.model_dump(include={"email", "full_name", "phone", "password"}),
         role=UserRole.DRIVER
     )
     
     driver_data = DriverCreate(
         user_id=0,  # Will be set after user creation
-        license_number=combined_data["license_number"],
-        license_expiry=combined_data["license_expiry"],
-        experience_years=combined_data["experience_years"]
+        **combined_data.model_dump(include={"license_number", "license_expiry", "experience_years"})
     )
     
-    # Check if user already exists
-    from ..models.user import User as UserModel
-    existing_user = db.query(UserModel).filter(UserModel.email == user_data.email).first()
-    if existing_user:
+    # Create user and driver profile in a single transaction; unique indexes on
+    # email and license number reject duplicates
+    try:
+        user = auth_service.create_user(db, user_data, commit=False)
+        driver_data.user_id = user.id
+        driver = auth_service.create_driver(db, driver_data, commit=False)
+        db.commit()
+    except IntegrityError:
+        db.rollback()
         raise HTTPException(
-            status_code=400,
-            detail="Email already registered"
+            status_code=409,
+            detail="Email or license number already registered"
         )
+    except Exception:
+        db.rollback()
+        raise
     
-    # Create user first
-    user = auth_service.create_user(db, user_data)
-    
-    # Create driver profile
-    driver_data.user_id = user.id
-    driver = auth_service.create_driver(db, driver_data)
-    
-    return driver
-    
-    # Create driver profile
-    driver_data.user_id = user.id
-    driver = auth_service.create_driver(db, driver_data)
-    
+    db.refresh(driver)
     return driver
 
 @router.post("/login", response_model=Token)
@@ -117,7 +118,7 @@ async def login(login_data: LoginRequest, db: Session = Depends(get_db)):
     return token
 
 @router.post("/login/facial", response_model=Token)
-async def facial_login(
+def facial_login(
     facial_data: FacialLoginRequest, 
     db: Session = Depends(get_db)
 ):
@@ -131,7 +132,7 @@ async def facial_login(
     return token
 
 @router.post("/upload-driver-face")
-async def upload_driver_face(
+def upload_driver_face(
     face_data: FaceUpload,
     db: Session = Depends(get_db),
     current_user: User = Depends(get_admin_user)  # Only admin can upload faces
@@ -164,13 +165,43 @@ async def get_current_user_info(
 
 @router.get("/drivers", response_model=List[Driver])
 async def get_all_drivers(
+    response: Response,
     skip: int = 0,
     limit: int = 100,
+    after_id: Optional[int] = None,
     db: Session = Depends(get_db),
     current_user: User = Depends(get_admin_user)  # Only admin can view all drivers
 ):
-    """Get all drivers (admin only)"""
-    return db.query(DriverModel).offset(skip).limit(limit).all()
+    """Get all drivers (admin only)
+
+    Pass the X-Next-After-Id header of a page as after_id to fetch the next one
+    with an index seek instead of an OFFSET scan.
+    """
+    # Plain column rows: read-only listing, no ORM identity map or instrumentation
+    # face_encodings is a large JSON blob no listing client reads; it is left out and
+    # comes back as null
+    driver_columns = [column for column in DriverModel.__table__.c if column.key != "face_encodings"]
+    user_columns = [column for column in UserModel.__table__.c if column.key != "hashed_password"]
+    stmt = (
+        select(*driver_columns, *user_columns)
+        .join(UserModel, UserModel.id == DriverModel.user_id)
+        .order_by(DriverModel.id)
+    )
+    if after_id is not None:
+        stmt = stmt.where(DriverModel.id > after_id)
+    else:
+        stmt = stmt.offset(skip)
+    
+    split = len(driver_columns)
+    drivers = []
+    for row in db.execute(stmt.limit(limit)):
+        driver = dict(zip((column.key for column in driver_columns), row[:split]))
+        driver["user"] = dict(zip((column.key for column in user_columns), row[split:]))
+        drivers.append(driver)
+    
+    if limit and len(drivers) == limit:
+        response.headers["X-Next-After-Id"] = str(drivers[-1]["id"])
+    return drivers
 
 @router.get("/users/{role}")
 async def get_users_by_role(
@@ -181,7 +212,7 @@ async def get_users_by_role(
     current_user: User = Depends(get_admin_user)  # Only admin can view users
 ):
     """Get users by role (admin only)"""
-    if role not in ["admin", "driver", "passenger"]:
+    if role not in USER_ROLES:
         raise HTTPException(status_code=400, detail="Invalid role")
     
     return auth_service.get_users_by_role(db, role, skip, limit)
@@ -193,10 +224,8 @@ async def change_password(
     current_user: User = Depends(get_current_active_user)
 ):
     """Change user password"""
-    from ..dependencies import verify_password, get_password_hash
-    
     # Verify current password
-    if not verify_password(password_data.current_password, current_user.hashed_password):
+    if not verify_password_cached(current_user.id, password_data.current_password, current_user.hashed_password):
         raise HTTPException(
             status_code=400,
             detail="Current password is incorrect"
@@ -211,20 +240,22 @@ async def change_password(
 # Facial Recognition Endpoints
 
 @router.post("/face/verify-quality", response_model=FaceQualityResponse)
-async def verify_face_quality(
+def verify_face_quality(
     face_data: FaceImageUpload,
     db: Session = Depends(get_db)
 ):
     """Verify the quality of a face image before processing"""
     try:
         # Decode base64 image
-        image_data = base64.b64decode(face_data.image_data)
+        image_data = decode_face_image(face_data.image_data)
         
         # Verify face quality
         quality_result = face_service.verify_face_quality(image_data)
         
         return FaceQualityResponse(**quality_result)
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=400,
@@ -232,7 +263,7 @@ async def verify_face_quality(
         )
 
 @router.post("/face/upload")
-async def upload_driver_face(
+def upload_driver_face(
     face_data: FaceImageUpload,
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_active_user)
@@ -258,7 +289,7 @@ async def upload_driver_face(
             )
         
         # Decode base64 image
-        image_data = base64.b64decode(face_data.image_data)
+        image_data = decode_face_image(face_data.image_data)
         
         # First verify image quality
         quality_result = face_service.verify_face_quality(image_data)
@@ -288,14 +319,14 @@ async def upload_driver_face(
         )
 
 @router.post("/face/login", response_model=FaceLoginResponse)
-async def face_login(
+def face_login(
     face_data: FaceLoginRequest,
     db: Session = Depends(get_db)
 ):
     """Authenticate driver using face recognition"""
     try:
         # Decode base64 image
-        image_data = base64.b64decode(face_data.image_data)
+        image_data = decode_face_image(face_data.image_data)
         
         # Authenticate using face recognition
         authenticated_driver = face_service.authenticate_driver_face(db, image_data)
@@ -307,7 +338,6 @@ async def face_login(
             )
         
         # Create access token
-        from ..dependencies import create_access_token
         access_token = create_access_token(
             data={"sub": authenticated_driver.user.email, "role": authenticated_driver.user.role}
         )
@@ -352,6 +382,7 @@ async def remove_driver_face(
         # Remove face encodings
         driver.face_encodings = None
         db.commit()
+        face_service.invalidate_encoding_index()
         
         return {"message": "Face data removed successfully"}
         
@@ -1,24 +1,37 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response, status
+from sqlalchemy import insert
 from sqlalchemy.orm import Session
 from typing import List, Optional
+from datetime import datetime
+import logging
+import orjson
 
 from ..database import get_db
 from ..dependencies import get_admin_user, get_current_driver, get_current_active_user
 from ..schemas import (
     Bus, BusCreate, BusUpdate, BusWithRoutes,
     Route, RouteCreate, RouteUpdate, RouteStop, Driver, User,
-    QRScanResponse, GPSLocationCreate
+    QRScanResponse, GPSLocationCreate, GPSLocationBatch
 )
-from ..services.bus_service import bus_service, route_service
+from ..services.bus_service import (
+    bus_service, route_service, QR_CACHE_TTL_SECONDS,
+    VISUALIZATION_CACHE_TTL_SECONDS, route_visualization_key
+)
+from ..services.cache_service import cache_service
+from ..models.user import Bus as BusModel, Route as RouteModel, RouteStop as RouteStopModel
+from ..utils.etag import collection_etag, not_modified
+from ..utils.ndjson import ndjson_response
 from ..services.map_service import map_service
 from ..services.bus_tracking import bus_tracking_service
 
+logger = logging.getLogger(__name__)
+
 router = APIRouter(prefix="/buses", tags=["bus-management"])
 
 # Bus Management Endpoints
 
 @router.post("/", response_model=Bus)
-async def create_bus(
+def create_bus(
     bus: BusCreate,
     db: Session = Depends(get_db),
     current_user: User = Depends(get_admin_user)
@@ -32,17 +45,26 @@ async def create_bus(
         raise HTTPException(status_code=500, detail="Internal server error")
 
 @router.get("/", response_model=List[Bus])
-async def get_buses(
+def get_buses(
+    request: Request,
+    response: Response,
     skip: int = 0,
     limit: int = 100,
+    response_format: Optional[str] = Query(None, alias="format"),
     db: Session = Depends(get_db),
     current_user: User = Depends(get_admin_user)
 ):
-    """Get all buses (admin only)"""
+    """Get all buses (admin only); ?format=ndjson streams one bus per line"""
+    etag = collection_etag(db, request, BusModel)
+    cached = not_modified(request, response, etag)
+    if cached:
+        return cached
+    if response_format == "ndjson":
+        return ndjson_response(bus_service.iter_buses(db, skip=skip, limit=limit), Bus, headers={"ETag": etag})
     return bus_service.get_buses(db, skip=skip, limit=limit)
 
 @router.get("/{bus_id}", response_model=BusWithRoutes)
-async def get_bus(
+def get_bus(
     bus_id: int,
     db: Session = Depends(get_db),
     current_user: User = Depends(get_admin_user)
@@ -54,7 +76,7 @@ async def get_bus(
     return bus
 
 @router.put("/{bus_id}", response_model=Bus)
-async def update_bus(
+def update_bus(
     bus_id: int,
     bus_update: BusUpdate,
     db: Session = Depends(get_db),
@@ -66,13 +88,15 @@ async def update_bus(
         if not bus:
             raise HTTPException(status_code=404, detail="Bus not found")
         return bus
+    except HTTPException:
+        raise
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail="Internal server error")
 
 @router.delete("/{bus_id}")
-async def delete_bus(
+def delete_bus(
     bus_id: int,
     db: Session = Depends(get_db),
     current_user: User = Depends(get_admin_user)
@@ -83,6 +107,8 @@ async def delete_bus(
         if not success:
             raise HTTPException(status_code=404, detail="Bus not found")
         return {"message": "Bus deleted successfully"}
+    except HTTPException:
+        raise
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
@@ -91,55 +117,64 @@ async def delete_bus(
 # QR Code and Tracking Endpoints
 
 @router.get("/{bus_id}/qr-info", response_model=QRScanResponse)
-async def get_bus_qr_info(
+def get_bus_qr_info(
     bus_id: int,
     db: Session = Depends(get_db)
 ):
     """Get bus information for QR code scan (public endpoint)"""
-    try:
+    def load_qr_info() -> bytes:
         bus_info = bus_service.get_bus_info_for_qr(db, bus_id)
+        # Serialized once per cache fill by pydantic-core; hits skip response_model validation
         return QRScanResponse(
             bus=bus_info["bus"],
             current_route=bus_info["current_route"],
             current_driver=bus_info["current_driver"]
-        )
+        ).model_dump_json().encode()
+    
+    try:
+        content = cache_service.get_or_set(f"qr:{bus_id}:info", QR_CACHE_TTL_SECONDS, load_qr_info)
+        return Response(content=content, media_type="application/json")
     except ValueError as e:
         raise HTTPException(status_code=404, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail="Internal server error")
 
 @router.get("/{bus_id}/qr-data")
-async def get_bus_qr_data(
+def get_bus_qr_data(
     bus_id: int,
     db: Session = Depends(get_db)
 ):
     """Get simplified bus data for QR code generation (public endpoint)"""
-    try:
+    def load_qr_data() -> bytes:
         bus_info = bus_service.get_bus_info_for_qr(db, bus_id)
         bus = bus_info["bus"]
         route = bus_info["current_route"]
         
         if not route:
-            return {
+            return orjson.dumps({
                 "bus_id": bus.id,
                 "bus_number": bus.bus_number,
                 "route_id": None,
                 "error": "No active route assigned"
-            }
+            })
         
-        return {
+        return orjson.dumps({
             "bus_id": bus.id,
             "bus_number": bus.bus_number,
             "route_id": route.id,
             "route_name": route.route_name
-        }
+        })
+    
+    try:
+        content = cache_service.get_or_set(f"qr:{bus_id}:data", QR_CACHE_TTL_SECONDS, load_qr_data)
+        return Response(content=content, media_type="application/json")
     except ValueError as e:
         raise HTTPException(status_code=404, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail="Internal server error")
 
 @router.post("/gps-location")
-async def record_gps_location(
+def record_gps_location(
     location: GPSLocationCreate,
     db: Session = Depends(get_db),
     current_driver: Driver = Depends(get_current_driver)
@@ -151,8 +186,21 @@ async def record_gps_location(
     except Exception as e:
         raise HTTPException(status_code=500, detail="Internal server error")
 
+@router.post("/gps-location/batch")
+def record_gps_locations(
+    batch: GPSLocationBatch,
+    db: Session = Depends(get_db),
+    current_driver: Driver = Depends(get_current_driver)
+):
+    """Record a batch of buffered GPS locations for current driver"""
+    try:
+        count = bus_service.record_gps_locations(db, batch.locations, current_driver.id)
+        return {"message": "GPS locations recorded successfully", "count": count}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail="Internal server error")
+
 @router.get("/available-drivers/", response_model=List[Driver])
-async def get_available_drivers(
+def get_available_drivers(
     db: Session = Depends(get_db),
     current_user: User = Depends(get_admin_user)
 ):
@@ -162,7 +210,7 @@ async def get_available_drivers(
 # Route Management Endpoints
 
 @router.post("/{bus_id}/routes", response_model=Route)
-async def create_route(
+def create_route(
     bus_id: int,
     route: RouteCreate,
     db: Session = Depends(get_db),
@@ -179,16 +227,21 @@ async def create_route(
         raise HTTPException(status_code=500, detail="Internal server error")
 
 @router.get("/{bus_id}/routes", response_model=List[Route])
-async def get_bus_routes(
+def get_bus_routes(
     bus_id: int,
+    request: Request,
+    response: Response,
     db: Session = Depends(get_db),
     current_user: User = Depends(get_admin_user)
 ):
     """Get all routes for a specific bus (admin only)"""
+    cached = not_modified(request, response, collection_etag(db, request, RouteModel, BusModel, RouteStopModel))
+    if cached:
+        return cached
     return route_service.get_routes_by_bus(db, bus_id)
 
 @router.get("/routes/{route_id}", response_model=Route)
-async def get_route(
+def get_route(
     route_id: int,
     db: Session = Depends(get_db),
     current_user: User = Depends(get_admin_user)
@@ -200,7 +253,7 @@ async def get_route(
     return route
 
 @router.put("/routes/{route_id}", response_model=Route)
-async def update_route(
+def update_route(
     route_id: int,
     route_update: RouteUpdate,
     db: Session = Depends(get_db),
@@ -212,13 +265,15 @@ async def update_route(
         if not route:
             raise HTTPException(status_code=404, detail="Route not found")
         return route
+    except HTTPException:
+        raise
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail="Internal server error")
 
 @router.delete("/routes/{route_id}")
-async def delete_route(
+def delete_route(
     route_id: int,
     db: Session = Depends(get_db),
     current_user: User = Depends(get_admin_user)
@@ -229,52 +284,82 @@ async def delete_route(
         if not success:
             raise HTTPException(status_code=404, detail="Route not found")
         return {"message": "Route deleted successfully"}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail="Internal server error")
 
 @router.get("/routes/", response_model=List[Route])
-async def get_all_routes(
+def get_all_routes(
+    request: Request,
+    response: Response,
     skip: int = 0,
     limit: int = 100,
+    response_format: Optional[str] = Query(None, alias="format"),
     db: Session = Depends(get_db),
     current_user: User = Depends(get_admin_user)
 ):
-    """Get all routes (admin only)"""
+    """Get all routes (admin only); ?format=ndjson streams one route per line"""
+    # Sweep first so expiring routes change the ETag
+    route_service.deactivate_expired_routes(db)
+    etag = collection_etag(db, request, RouteModel, BusModel, RouteStopModel)
+    cached = not_modified(request, response, etag)
+    if cached:
+        return cached
+    if response_format == "ndjson":
+        return ndjson_response(route_service.iter_routes(db, skip=skip, limit=limit), Route, headers={"ETag": etag})
     return route_service.get_routes(db, skip=skip, limit=limit)
 
 @router.get("/routes/{route_id}/stops", response_model=List[RouteStop])
-async def get_route_stops(
+def get_route_stops(
     route_id: int,
+    request: Request,
+    response: Response,
     db: Session = Depends(get_db),
     current_user: User = Depends(get_admin_user)
 ):
     """Get all stops for a specific route (admin only)"""
-    # First check if route exists
-    route = route_service.get_route_by_id(db, route_id)
-    if not route:
+    cached = not_modified(request, response, collection_etag(db, request, RouteStopModel))
+    if cached:
+        return cached
+    stops = route_service.get_route_stops(db, route_id)
+    if stops is None:
         raise HTTPException(status_code=404, detail="Route not found")
     
-    return route_service.get_route_stops(db, route_id)
+    return stops
 
 # Map Visualization Endpoints
 
+def _cached_route_visualization(route_id: int, build) -> Response:
+    """Serve a route's map data from the cache, building and serializing it once on a miss"""
+    def load() -> bytes:
+        route_data = build()
+        if not route_data:
+            # Raised inside the loader so the miss is not cached
+            raise HTTPException(status_code=404, detail="Route not found or has no stops")
+        return orjson.dumps(route_data)
+    
+    content = cache_service.get_or_set(route_visualization_key(route_id), VISUALIZATION_CACHE_TTL_SECONDS, load)
+    return Response(content=content, media_type="application/json")
+
 @router.get("/routes/{route_id}/map-data")
-async def get_route_map_data(
+def get_route_map_data(
     route_id: int,
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_active_user)
 ):
     """Get route visualization data for map display (accessible to admin and drivers)"""
     try:
-        route_data = map_service.get_route_visualization_data(db, route_id)
-        if not route_data:
-            raise HTTPException(status_code=404, detail="Route not found or has no stops")
-        return route_data
+        return _cached_route_visualization(
+            route_id, lambda: map_service.get_route_visualization_data(db, route_id)
+        )
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail="Internal server error")
 
 @router.get("/{bus_id}/live-location")
-async def get_live_bus_location(
+def get_live_bus_location(
     bus_id: int,
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_active_user)
@@ -289,27 +374,27 @@ async def get_live_bus_location(
         raise HTTPException(status_code=500, detail="Internal server error")
 
 @router.get("/driver/route-map")
-async def get_driver_route_map(
+def get_driver_route_map(
     db: Session = Depends(get_db),
     current_driver: Driver = Depends(get_current_driver)
 ):
     """Get route map data for current driver"""
     try:
-        # Get driver's active route
-        active_route = route_service.get_driver_active_route(db, current_driver.id)
+        # Get driver's active route with its stops
+        active_route = route_service.get_driver_active_route_with_stops(db, current_driver.id)
         if not active_route:
             raise HTTPException(status_code=404, detail="No active route found")
         
-        route_data = map_service.get_route_visualization_data(db, active_route.id)
-        if not route_data:
-            raise HTTPException(status_code=404, detail="Route data not available")
-        
-        return route_data
+        return _cached_route_visualization(
+            active_route.id, lambda: map_service.build_visualization_from_route(db, active_route)
+        )
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail="Internal server error")
 
 @router.get("/driver/next-stop")
-async def get_next_stop_info(
+def get_next_stop_info(
     latitude: float,
     longitude: float,
     db: Session = Depends(get_db),
@@ -317,14 +402,12 @@ async def get_next_stop_info(
 ):
     """Get information about the next stop for current driver"""
     try:
-        # Get driver's active route
-        active_route = route_service.get_driver_active_route(db, current_driver.id)
+        # Get driver's active route with its stops
+        active_route = route_service.get_driver_active_route_with_stops(db, current_driver.id)
         if not active_route:
             raise HTTPException(status_code=404, detail="No active route found")
         
-        next_stop_data = map_service.calculate_distance_to_next_stop(
-            latitude, longitude, active_route.id, db
-        )
+        next_stop_data = map_service.next_stop_from_stops(latitude, longitude, active_route.stops)
         
         if not next_stop_data:
             raise HTTPException(status_code=404, detail="No upcoming stops found")
@@ -336,7 +419,7 @@ async def get_next_stop_info(
 # Enhanced Bus Tracking Endpoints
 
 @router.post("/driver/update-location")
-async def update_driver_location(
+def update_driver_location(
     location_data: GPSLocationCreate,
     db: Session = Depends(get_db),
     current_driver: Driver = Depends(get_current_driver)
@@ -355,7 +438,7 @@ async def update_driver_location(
         raise HTTPException(status_code=500, detail="Internal server error")
 
 @router.get("/driver/proximity-check")
-async def check_proximity_alerts(
+def check_proximity_alerts(
     latitude: float,
     longitude: float,
     db: Session = Depends(get_db),
@@ -374,7 +457,7 @@ async def check_proximity_alerts(
         raise HTTPException(status_code=500, detail="Internal server error")
 
 @router.get("/{bus_id}/live-tracking")
-async def get_live_tracking_data(
+def get_live_tracking_data(
     bus_id: int,
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_active_user)
@@ -389,44 +472,43 @@ async def get_live_tracking_data(
         raise HTTPException(status_code=500, detail="Internal server error")
 
 @router.post("/emergency-alert")
-async def emergency_alert(
+def emergency_alert(
     emergency_data: dict,
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_active_user)
 ):
-    """Send emergency alert from driver"""
+    """Send emergency alert from driver; the alert is stored before the driver is told it was sent"""
+    from .sos import SOSAlert
+    
+    alert_fields = {
+        'bus_id': emergency_data.get('bus_id'),
+        'bus_number': emergency_data.get('bus_number', 'Unknown'),
+        'driver_id': emergency_data.get('driver_id', current_user.id),
+        'driver_name': current_user.full_name,
+        'latitude': emergency_data.get('latitude'),
+        'longitude': emergency_data.get('longitude'),
+        'emergency_type': emergency_data.get('emergency_type', 'other'),
+        'message': emergency_data.get('message', 'Emergency alert from driver'),
+        'priority': 'high',
+        'created_at': datetime.utcnow()
+    }
+    missing = [field for field in ('bus_id', 'driver_id', 'latitude', 'longitude') if alert_fields[field] is None]
+    if missing:
+        raise HTTPException(status_code=400, detail=f"Emergency alert missing fields: {', '.join(missing)}")
+    
     try:
-        # Import SOS model
-        from .sos import SOSAlert
-        
-        # Create SOS alert in database
-        sos_alert = SOSAlert(
-            bus_id=emergency_data.get('bus_id'),
-            bus_number=emergency_data.get('bus_number', 'Unknown'),
-            driver_id=emergency_data.get('driver_id', current_user.id),
-            driver_name=current_user.full_name,
-            latitude=emergency_data.get('latitude'),
-            longitude=emergency_data.get('longitude'),
-            emergency_type=emergency_data.get('emergency_type', 'other'),
-            message=emergency_data.get('message', 'Emergency alert from driver'),
-            priority='high'
-        )
-        
-        db.add(sos_alert)
+        # One INSERT ... RETURNING round trip; no refresh needed for the id
+        alert_id = db.scalar(insert(SOSAlert).values(**alert_fields).returning(SOSAlert.id))
         db.commit()
-        db.refresh(sos_alert)
-        
-        # Log the emergency alert
-        import logging
-        logging.warning(f"EMERGENCY ALERT CREATED: ID={sos_alert.id}, BUS={sos_alert.bus_id}, TYPE={sos_alert.emergency_type}")
-        
-        return {
-            "status": "success",
-            "message": "Emergency alert sent successfully",
-            "alert_id": sos_alert.id,
-            "timestamp": sos_alert.created_at.timestamp()
-        }
-        
     except Exception as e:
         db.rollback()
+        logger.error(f"EMERGENCY ALERT NOT SAVED: DATA={alert_fields}: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Emergency alert failed: {str(e)}")
+    
+    logger.warning(f"EMERGENCY ALERT CREATED: ID={alert_id}, BUS={alert_fields['bus_id']}, TYPE={alert_fields['emergency_type']}")
+    return {
+        "status": "success",
+        "message": "Emergency alert sent successfully",
+        "alert_id": alert_id,
+        "timestamp": alert_fields['created_at'].timestamp()
+    }
@@ -1,20 +1,39 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from sqlalchemy import func
+from sqlalchemy.orm import Session, contains_eager, selectinload
 from datetime import datetime, timedelta
 import random
+import secrets
 import string
 import uuid
 import math
-from typing import List, Optional
+from typing import Any, Dict, List, Optional
+import numpy as np
 
 from ..database import get_db
 from ..dependencies import get_current_user
 from ..schemas import User
-from ..models.user import Route, RouteStop, Bus, GPSTracking
+from ..models.user import Route, RouteStop, GPSTracking
+from ..utils.geo import bounding_box_mask, cumulative_path_km, haversine_km_from_rad, haversine_km_rad, haversine_km_vec
+from ..utils.ndjson import dicts_ndjson_response
+from ..services.cache_service import cache_service
+from ..services.bus_service import PASSENGER_CACHE_PREFIX
 from pydantic import BaseModel
 
 router = APIRouter(prefix="/passenger", tags=["passenger"])
 
+# Stops and routes change only through admin route edits, which drop these keys;
+# bus positions are volatile so they get their own short TTL
+STOPS_CACHE_KEY = f"{PASSENGER_CACHE_PREFIX}stops"
+ROUTES_CACHE_KEY = f"{PASSENGER_CACHE_PREFIX}routes"
+LATEST_GPS_CACHE_KEY = f"{PASSENGER_CACHE_PREFIX}latest_gps"
+PASSENGER_CACHE_TTL_SECONDS = 60
+LATEST_GPS_TTL_SECONDS = 5
+
+# Below this many stops a plain Python scan beats NumPy's per-call overhead
+# (crossover measured at ~16 stops)
+SMALL_STOP_COUNT = 16
+
 # Pydantic models for passenger booking
 class LocationInput(BaseModel):
     latitude: float
@@ -75,69 +94,209 @@ class TicketResponse(BaseModel):
     fare: float
 
 # Database query functions
-def fetch_all_bus_stops(db: Session) -> List[dict]:
-    """Get all bus stops from database"""
-    stops = db.query(RouteStop).all()
-    return [
-        {
-            "id": stop.id,
-            "name": stop.stop_name,  # Fixed: use stop_name instead of name
-            "latitude": float(stop.latitude) if stop.latitude else 0.0,
-            "longitude": float(stop.longitude) if stop.longitude else 0.0,
-            "stop_order": stop.stop_order
+def fetch_all_bus_stops(db: Session) -> list:
+    """Get all bus stops that have coordinates, as plain column rows (no ORM objects)"""
+    return db.query(
+        RouteStop.id,
+        RouteStop.stop_name,
+        RouteStop.latitude,
+        RouteStop.longitude,
+        RouteStop.stop_order
+    ).filter(
+        # Only include stops with coordinates (NULL or 0 means not geocoded)
+        RouteStop.latitude.isnot(None), RouteStop.latitude != 0,
+        RouteStop.longitude.isnot(None), RouteStop.longitude != 0
+    ).all()
+
+def _load_stops_arrays(db: Session) -> Dict[str, Any]:
+    """Stops with coordinates as parallel arrays, so distances can be computed in one NumPy pass"""
+    def load():
+        rows = fetch_all_bus_stops(db)
+        count = len(rows)
+        lat = np.fromiter((row.latitude for row in rows), dtype=np.float64, count=count)
+        lng = np.fromiter((row.longitude for row in rows), dtype=np.float64, count=count)
+        lat_rad = np.radians(lat)
+        lng_rad = np.radians(lng)
+        cos_lat = np.cos(lat_rad)
+        return {
+            "ids": np.fromiter((row.id for row in rows), dtype=np.int64, count=count),
+            "names": [row.stop_name for row in rows],
+            "lat": lat,
+            "lng": lng,
+            # Converted once per cache fill; requests only convert the user's point
+            "lat_rad": lat_rad,
+            "lng_rad": lng_rad,
+            "cos_lat": cos_lat,
+            # Plain floats for the small-table scan in find_closest_bus_stop
+            "coords_rad": list(zip(lat_rad.tolist(), lng_rad.tolist(), cos_lat.tolist())),
+            "orders": np.fromiter((row.stop_order for row in rows), dtype=np.int64, count=count),
+            "index_by_id": {row.id: i for i, row in enumerate(rows)}
+        }
+    
+    return cache_service.get_or_set(STOPS_CACHE_KEY, PASSENGER_CACHE_TTL_SECONDS, load)
+
+def _stop_distances(stops_np: Dict[str, Any], latitude: float, longitude: float) -> np.ndarray:
+    """Distance in km from a point to every cached stop"""
+    return haversine_km_rad(
+        math.radians(latitude), math.radians(longitude),
+        stops_np["lat_rad"], stops_np["lng_rad"], stops_np["cos_lat"]
+    )
+
+def _stop_from_arrays(stops_np: Dict[str, Any], index: int, distance_km: Optional[float] = None) -> "BusStop":
+    # Values are already cast from the typed cache arrays; the response model validates once on the way out
+    return BusStop.model_construct(
+        id=int(stops_np["ids"][index]),
+        name=stops_np["names"][index],
+        latitude=float(stops_np["lat"][index]),
+        longitude=float(stops_np["lng"][index]),
+        stop_order=int(stops_np["orders"][index]),
+        distance_km=distance_km
+    )
+
+def _iter_stop_dicts(stops_np: Dict[str, Any], order, distances: Optional[np.ndarray] = None):
+    """BusStop-shaped dicts straight from the cache arrays, for streaming"""
+    ids, names, orders = stops_np["ids"].tolist(), stops_np["names"], stops_np["orders"].tolist()
+    lat, lng = stops_np["lat"].tolist(), stops_np["lng"].tolist()
+    for i in order:
+        yield {
+            "id": ids[i],
+            "name": names[i],
+            "latitude": lat[i],
+            "longitude": lng[i],
+            "stop_order": orders[i],
+            "distance_km": float(distances[i]) if distances is not None else None
         }
-        for stop in stops if stop.latitude and stop.longitude  # Only include stops with coordinates
-    ]
 
-def get_routes_with_stops(db: Session) -> List[dict]:
-    """Get all routes with their stops from database"""
-    routes = db.query(Route).filter(Route.is_active == True).all()
+def get_stop_by_id(db: Session, stop_id: int) -> Optional["BusStop"]:
+    """Stop by id from the cached stop table, falling back to the database for stops without coordinates"""
+    stops_np = _load_stops_arrays(db)
+    index = stops_np["index_by_id"].get(stop_id)
+    if index is not None:
+        return _stop_from_arrays(stops_np, index)
+    
+    stop = db.query(RouteStop).filter(RouteStop.id == stop_id).first()
+    if not stop:
+        return None
+    return BusStop(
+        id=stop.id,
+        name=stop.stop_name,
+        latitude=float(stop.latitude) if stop.latitude else 0.0,
+        longitude=float(stop.longitude) if stop.longitude else 0.0,
+        stop_order=stop.stop_order
+    )
+
+def fetch_latest_bus_locations(db: Session, bus_ids: List[int]) -> Dict[int, tuple]:
+    """Latest GPS fix per bus as {bus_id: (lat, lng)}, in one windowed query"""
+    if not bus_ids:
+        return {}
+    
+    ranked = db.query(
+        GPSTracking.bus_id,
+        GPSTracking.latitude,
+        GPSTracking.longitude,
+        func.row_number().over(
+            partition_by=GPSTracking.bus_id,
+            order_by=GPSTracking.timestamp.desc()
+        ).label("rn")
+    ).filter(GPSTracking.bus_id.in_(bus_ids)).subquery()
+    
+    rows = db.query(ranked.c.bus_id, ranked.c.latitude, ranked.c.longitude).filter(ranked.c.rn == 1).all()
+    return {row.bus_id: (float(row.latitude), float(row.longitude)) for row in rows}
+
+def _load_routes(db: Session) -> Dict[str, Any]:
+    """
+    Active routes as a column table: per-route dicts for the response fields plus
+    NumPy arrays of bus ids and fallback positions (no live position)
+    """
+    # Routes with their bus and ordered stops in two queries, instead of three per route;
+    # stops only carry the columns read below (the relationship orders by stop_order)
+    routes = db.query(Route).join(Route.bus).options(
+        contains_eager(Route.bus),
+        selectinload(Route.stops).load_only(
+            RouteStop.id, RouteStop.stop_order, RouteStop.latitude, RouteStop.longitude
+        )
+    ).filter(Route.is_active == True).all()
     result = []
+    count = len(routes)
+    first_lat = np.zeros(count, dtype=np.float64)
+    first_lng = np.zeros(count, dtype=np.float64)
     
-    for route in routes:
-        # Get all stops for this route
-        stops = db.query(RouteStop).filter(RouteStop.route_id == route.id).order_by(RouteStop.stop_order).all()
+    for i, route in enumerate(routes):
+        stops = route.stops
         
-        # Get bus information
-        bus = db.query(Bus).filter(Bus.id == route.bus_id).first()
-        if not bus:
-            continue
-            
-        # Get current location from GPS tracking or use first stop location
-        current_location = {"lat": 0.0, "lng": 0.0}
+        # Fallback location when the bus has no GPS fix yet: its first stop
+        if stops and stops[0].latitude and stops[0].longitude:
+            first_lat[i] = stops[0].latitude
+            first_lng[i] = stops[0].longitude
         
-        # Try to get latest GPS location for this bus
-        latest_gps = db.query(GPSTracking).filter(
-            GPSTracking.bus_id == route.bus_id
-        ).order_by(GPSTracking.timestamp.desc()).first()
+        # Distance along the route up to each stop, so fares need no trig per booking
+        cum_km = None
+        if stops and all(stop.latitude is not None and stop.longitude is not None for stop in stops):
+            cum_km = cumulative_path_km(
+                np.array([stop.latitude for stop in stops], dtype=np.float64),
+                np.array([stop.longitude for stop in stops], dtype=np.float64)
+            ).tolist()
         
-        if latest_gps:
-            current_location = {
-                "lat": float(latest_gps.latitude),
-                "lng": float(latest_gps.longitude)
-            }
-        elif stops and stops[0].latitude and stops[0].longitude:
-            # Fallback to first stop location
-            current_location = {
-                "lat": float(stops[0].latitude),
-                "lng": float(stops[0].longitude)
-            }
-        
-        route_data = {
+        result.append({
             "id": route.id,
             "name": route.route_name,
             "bus_id": route.bus_id,
-            "bus_number": bus.bus_number,
+            "bus_number": route.bus.bus_number,
             "stops": [stop.id for stop in stops],
-            "current_location": current_location,
+            "stops_pos": {stop.id: i for i, stop in enumerate(stops)},
+            "cum_km": cum_km,
             "origin": route.origin,
             "destination": route.destination,
             "distance_km": route.distance_km,
             "is_active": route.is_active
-        }
-        result.append(route_data)
+        })
+    
+    return {
+        "routes": result,
+        "bus_ids": np.fromiter((route["bus_id"] for route in result), dtype=np.int64, count=count),
+        "stops_pos": [route["stops_pos"] for route in result],
+        "first_lat": first_lat,
+        "first_lng": first_lng
+    }
+
+def _cached_routes(db: Session) -> Dict[str, Any]:
+    return cache_service.get_or_set(ROUTES_CACHE_KEY, PASSENGER_CACHE_TTL_SECONDS, lambda: _load_routes(db))
+
+def get_routes_table(db: Session) -> Dict[str, Any]:
+    """
+    The cached route table plus "lat"/"lng" arrays with each bus's current position:
+    its latest GPS fix, or its route's first stop when it has none
+    """
+    table = _cached_routes(db)
+    latest_gps = cache_service.get_or_set(
+        LATEST_GPS_CACHE_KEY, LATEST_GPS_TTL_SECONDS,
+        lambda: fetch_latest_bus_locations(db, np.unique(table["bus_ids"]).tolist())
+    )
+    
+    lats = table["first_lat"].copy()
+    lngs = table["first_lng"].copy()
+    if latest_gps and len(lats):
+        # Join bus ids to GPS fixes with a sorted lookup instead of a per-route dict probe
+        gps_ids = np.fromiter(latest_gps.keys(), dtype=np.int64, count=len(latest_gps))
+        gps_coords = np.array(list(latest_gps.values()), dtype=np.float64)
+        order = np.argsort(gps_ids)
+        gps_ids, gps_coords = gps_ids[order], gps_coords[order]
+        
+        pos = np.minimum(np.searchsorted(gps_ids, table["bus_ids"]), len(gps_ids) - 1)
+        has_fix = gps_ids[pos] == table["bus_ids"]
+        lats[has_fix] = gps_coords[pos[has_fix], 0]
+        lngs[has_fix] = gps_coords[pos[has_fix], 1]
     
-    return result
+    # New dict so callers never mutate the cached table
+    return {**table, "lat": lats, "lng": lngs}
+
+def get_route_for_bus(db: Session, bus_id: int) -> Optional[dict]:
+    """The bus's active route (lowest id if several) from the route cache, without live position"""
+    return min(
+        (route for route in _cached_routes(db)["routes"] if route["bus_id"] == bus_id),
+        key=lambda route: route["id"],
+        default=None
+    )
 
 def calculate_distance(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
     """Calculate distance between two coordinates using Haversine formula"""
@@ -158,61 +317,66 @@ def calculate_distance(lat1: float, lon1: float, lat2: float, lon2: float) -> fl
 
 def find_closest_bus_stop(user_lat: float, user_lng: float, db: Session) -> BusStop:
     """Find the closest bus stop to user's location"""
-    all_stops = fetch_all_bus_stops(db)  # Updated function name
-    closest_stop = None
-    min_distance = float('inf')
+    stops_np = _load_stops_arrays(db)
+    if not len(stops_np["ids"]):
+        raise HTTPException(status_code=404, detail="No bus stops found")
     
-    for stop in all_stops:
-        distance = calculate_distance(user_lat, user_lng, stop["latitude"], stop["longitude"])
-        if distance < min_distance:
-            min_distance = distance
-            closest_stop = stop
+    if len(stops_np["ids"]) < SMALL_STOP_COUNT:
+        # Tiny tables: a scalar scan over the cached radians is cheaper than array setup
+        user_lat_rad, user_lng_rad = math.radians(user_lat), math.radians(user_lng)
+        user_cos_lat = math.cos(user_lat_rad)
+        distances = [
+            haversine_km_from_rad(user_lat_rad, user_lng_rad, user_cos_lat, lat_rad, lng_rad, cos_lat)
+            for lat_rad, lng_rad, cos_lat in stops_np["coords_rad"]
+        ]
+        closest = min(range(len(distances)), key=distances.__getitem__)
+        return _stop_from_arrays(stops_np, closest, distances[closest])
     
-    if closest_stop:
-        return BusStop(
-            id=closest_stop["id"],
-            name=closest_stop["name"],
-            latitude=closest_stop["latitude"],
-            longitude=closest_stop["longitude"],
-            stop_order=closest_stop["stop_order"],
-            distance_km=min_distance
-        )
-    raise HTTPException(status_code=404, detail="No bus stops found")
+    distances = _stop_distances(stops_np, user_lat, user_lng)
+    closest = int(distances.argmin())
+    return _stop_from_arrays(stops_np, closest, float(distances[closest]))
 
 def find_buses_within_radius(user_lat: float, user_lng: float, max_distance_km: float, db: Session) -> List[BusOnRoute]:
     """Find all buses within specified radius of user location"""
     nearby_buses = []
-    all_routes = get_routes_with_stops(db)
+    table = get_routes_table(db)
+    if not table["routes"]:
+        return nearby_buses
+    
+    bus_lats, bus_lngs = table["lat"], table["lng"]
+    
+    # Haversine only for buses inside the radius's bounding box
+    candidates = np.flatnonzero(bounding_box_mask(user_lat, user_lng, bus_lats, bus_lngs, max_distance_km))
+    distances = haversine_km_vec(user_lat, user_lng, bus_lats[candidates], bus_lngs[candidates])
     
-    for route in all_routes:
-        bus_lat = route["current_location"]["lat"]
-        bus_lng = route["current_location"]["lng"]
-        distance = calculate_distance(user_lat, user_lng, bus_lat, bus_lng)
+    # Buses in range, nearest first
+    in_range = np.flatnonzero(distances <= max_distance_km)
+    for j in in_range[np.argsort(distances[in_range], kind="stable")]:
+        k = candidates[j]
+        route = table["routes"][k]
+        distance = float(distances[j])
         
-        if distance <= max_distance_km:
-            # Calculate estimated arrival (mock calculation)
-            estimated_arrival = max(1, int(distance * 10))  # Rough estimate: 10 minutes per km
-            
-            bus = BusOnRoute(
-                bus_id=route["bus_id"],
-                bus_number=route["bus_number"],
-                current_latitude=bus_lat,
-                current_longitude=bus_lng,
-                distance_from_user_km=distance,
-                estimated_arrival_minutes=estimated_arrival,
-                route_id=route["id"],
-                route_name=route["name"],
-                next_stop=f"Stop {route['stops'][0]}",
-                stops_remaining=len(route["stops"])
-            )
-            nearby_buses.append(bus)
+        # Calculate estimated arrival (mock calculation)
+        estimated_arrival = max(1, int(distance * 10))  # Rough estimate: 10 minutes per km
+        
+        bus = BusOnRoute.model_construct(
+            bus_id=route["bus_id"],
+            bus_number=route["bus_number"],
+            current_latitude=float(bus_lats[k]),
+            current_longitude=float(bus_lngs[k]),
+            distance_from_user_km=distance,
+            estimated_arrival_minutes=estimated_arrival,
+            route_id=route["id"],
+            route_name=route["name"],
+            next_stop=f"Stop {route['stops'][0]}",
+            stops_remaining=len(route["stops"])
+        )
+        nearby_buses.append(bus)
     
-    # Sort by distance
-    nearby_buses.sort(key=lambda x: x.distance_from_user_km or float('inf'))
     return nearby_buses
 
 @router.post("/search-routes", response_model=RouteVisualization)
-async def search_routes(
+def search_routes(
     search_request: RouteSearchRequest,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
@@ -225,16 +389,9 @@ async def search_routes(
         # Determine source stop
         if search_request.source_stop_id:
             # Use provided source stop
-            source_stop_obj = db.query(RouteStop).filter(RouteStop.id == search_request.source_stop_id).first()
-            if not source_stop_obj:
+            source_stop = get_stop_by_id(db, search_request.source_stop_id)
+            if not source_stop:
                 raise HTTPException(status_code=404, detail="Source stop not found")
-            source_stop = BusStop(
-                id=source_stop_obj.id,
-                name=source_stop_obj.stop_name,  # Fixed: use stop_name
-                latitude=float(source_stop_obj.latitude) if source_stop_obj.latitude else 0.0,
-                longitude=float(source_stop_obj.longitude) if source_stop_obj.longitude else 0.0,
-                stop_order=source_stop_obj.stop_order
-            )
         elif search_request.source_location:
             # Find closest stop to user's location
             source_stop = find_closest_bus_stop(
@@ -246,55 +403,59 @@ async def search_routes(
             raise HTTPException(status_code=400, detail="Either source_stop_id or source_location must be provided")
         
         # Get destination stop
-        destination_stop_obj = db.query(RouteStop).filter(RouteStop.id == search_request.destination_stop_id).first()
-        if not destination_stop_obj:
+        destination_stop = get_stop_by_id(db, search_request.destination_stop_id)
+        if not destination_stop:
             raise HTTPException(status_code=404, detail="Destination stop not found")
-        destination_stop = BusStop(
-            id=destination_stop_obj.id,
-            name=destination_stop_obj.stop_name,  # Fixed: use stop_name
-            latitude=float(destination_stop_obj.latitude) if destination_stop_obj.latitude else 0.0,
-            longitude=float(destination_stop_obj.longitude) if destination_stop_obj.longitude else 0.0,
-            stop_order=destination_stop_obj.stop_order
-        )
         
         # Find routes that connect source and destination
+        table = get_routes_table(db)
+        matched, source_indexes, dest_indexes = [], [], []
+        for k, stops_pos in enumerate(table["stops_pos"]):
+            # Both stops on the route, with source before destination
+            source_index = stops_pos.get(source_stop.id)
+            if source_index is None:
+                continue
+            dest_index = stops_pos.get(destination_stop.id)
+            if dest_index is None or source_index >= dest_index:
+                continue
+            matched.append(k)
+            source_indexes.append(source_index)
+            dest_indexes.append(dest_index)
+        
+        bus_lats = table["lat"][matched]
+        bus_lngs = table["lng"][matched]
+        
+        # Calculate distance from user (if location provided) for all matches at once
+        distances_from_user = [None] * len(matched)
+        if search_request.source_location and matched:
+            distances_from_user = haversine_km_vec(
+                search_request.source_location.latitude,
+                search_request.source_location.longitude,
+                bus_lats,
+                bus_lngs
+            ).tolist()
+        
         connecting_routes = []
-        all_routes = get_routes_with_stops(db)
-        for route in all_routes:
-            if source_stop.id in route["stops"] and destination_stop.id in route["stops"]:
-                # Check if source comes before destination in the route
-                source_index = route["stops"].index(source_stop.id)
-                dest_index = route["stops"].index(destination_stop.id)
-                
-                if source_index < dest_index:
-                    bus_lat = route["current_location"]["lat"]
-                    bus_lng = route["current_location"]["lng"]
-                    
-                    # Calculate distance from user (if location provided)
-                    distance_from_user = None
-                    if search_request.source_location:
-                        distance_from_user = calculate_distance(
-                            search_request.source_location.latitude,
-                            search_request.source_location.longitude,
-                            bus_lat, bus_lng
-                        )
-                    
-                    estimated_arrival = 5 + random.randint(1, 15)  # Mock calculation
-                    stops_remaining = dest_index - source_index
-                    
-                    bus = BusOnRoute(
-                        bus_id=route["bus_id"],
-                        bus_number=route["bus_number"],
-                        current_latitude=bus_lat,
-                        current_longitude=bus_lng,
-                        distance_from_user_km=distance_from_user,
-                        estimated_arrival_minutes=estimated_arrival,
-                        route_id=route["id"],
-                        route_name=route["name"],
-                        next_stop=f"Stop {route['stops'][source_index]}",
-                        stops_remaining=stops_remaining
-                    )
-                    connecting_routes.append(bus)
+        for k, source_index, dest_index, bus_lat, bus_lng, distance_from_user in zip(
+            matched, source_indexes, dest_indexes, bus_lats.tolist(), bus_lngs.tolist(), distances_from_user
+        ):
+            route = table["routes"][k]
+            estimated_arrival = 5 + random.randint(1, 15)  # Mock calculation
+            stops_remaining = dest_index - source_index
+            
+            bus = BusOnRoute.model_construct(
+                bus_id=route["bus_id"],
+                bus_number=route["bus_number"],
+                current_latitude=bus_lat,
+                current_longitude=bus_lng,
+                distance_from_user_km=distance_from_user,
+                estimated_arrival_minutes=estimated_arrival,
+                route_id=route["id"],
+                route_name=route["name"],
+                next_stop=f"Stop {route['stops'][source_index]}",
+                stops_remaining=stops_remaining
+            )
+            connecting_routes.append(bus)
         
         if not connecting_routes:
             raise HTTPException(status_code=404, detail="No routes found connecting source and destination")
@@ -337,7 +498,7 @@ async def search_routes(
         )
 
 @router.get("/nearby-buses")
-async def get_nearby_buses(
+def get_nearby_buses(
     latitude: float,
     longitude: float,
     max_distance_km: float = 3.0,
@@ -363,7 +524,7 @@ async def get_nearby_buses(
         )
 
 @router.post("/book-ticket", response_model=TicketResponse)
-async def book_ticket(
+def book_ticket(
     booking_request: TicketBookingRequest,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
@@ -371,33 +532,40 @@ async def book_ticket(
     """Book a ticket for selected bus and route"""
     try:
         # Find the bus and route info from database
-        all_routes = get_routes_with_stops(db)
-        route = next((r for r in all_routes if r["bus_id"] == booking_request.bus_id), None)
+        route = get_route_for_bus(db, booking_request.bus_id)
         if not route:
             raise HTTPException(status_code=404, detail="Bus not found")
         
-        # Get stop information from database
-        source_stop_obj = db.query(RouteStop).filter(RouteStop.id == booking_request.source_stop_id).first()
-        dest_stop_obj = db.query(RouteStop).filter(RouteStop.id == booking_request.destination_stop_id).first()
+        # Get both stops in one query
+        stop_ids = [booking_request.source_stop_id, booking_request.destination_stop_id]
+        stops_by_id = {stop.id: stop for stop in db.query(RouteStop).filter(RouteStop.id.in_(stop_ids)).all()}
+        source_stop_obj = stops_by_id.get(booking_request.source_stop_id)
+        dest_stop_obj = stops_by_id.get(booking_request.destination_stop_id)
         
         if not source_stop_obj or not dest_stop_obj:
             raise HTTPException(status_code=404, detail="Stop not found")
         
-        # Generate ticket
+        # Generate ticket; one clock read serves every timestamp, and the codes
+        # come from the OS CSPRNG since the one-time code gates boarding
+        now = datetime.now()
         ticket_id = str(uuid.uuid4())
-        qr_code = f"QR{datetime.now().strftime('%Y%m%d%H%M%S')}{random.randint(1000, 9999)}"
-        one_time_code = str(random.randint(1000, 9999))
+        qr_code = f"QR{now:%Y%m%d%H%M%S}{secrets.randbelow(9000) + 1000}"
+        one_time_code = str(secrets.randbelow(9000) + 1000)
         
-        # Calculate fare based on distance
-        distance = calculate_distance(
-            float(source_stop_obj.latitude), float(source_stop_obj.longitude),
-            float(dest_stop_obj.latitude), float(dest_stop_obj.longitude)
-        )
+        # Calculate fare based on the distance travelled along the route; stops
+        # off this bus's route fall back to the straight-line distance
+        source_index = route["stops_pos"].get(source_stop_obj.id)
+        dest_index = route["stops_pos"].get(dest_stop_obj.id)
+        if route["cum_km"] is not None and source_index is not None and dest_index is not None:
+            distance = abs(route["cum_km"][dest_index] - route["cum_km"][source_index])
+        else:
+            distance = calculate_distance(
+                float(source_stop_obj.latitude), float(source_stop_obj.longitude),
+                float(dest_stop_obj.latitude), float(dest_stop_obj.longitude)
+            )
         base_fare = 10.0
         fare = base_fare + (distance * 5.0)  # 5 rupees per km
         
-        expires_at = datetime.now() + timedelta(hours=1)
-        
         ticket = TicketResponse(
             id=ticket_id,
             bus_id=booking_request.bus_id,
@@ -407,9 +575,9 @@ async def book_ticket(
             destination_stop=dest_stop_obj.stop_name,  # Fixed: use stop_name
             qr_code=qr_code,
             one_time_code=one_time_code,
-            expires_at=expires_at.isoformat(),
+            expires_at=(now + timedelta(hours=1)).isoformat(),
             status="active",
-            created_at=datetime.now().isoformat(),
+            created_at=now.isoformat(),
             fare=round(fare, 2)
         )
         
@@ -424,37 +592,33 @@ async def book_ticket(
         )
 
 @router.get("/bus-stops")
-async def get_all_bus_stops(
+def get_all_bus_stops(
     latitude: Optional[float] = None,
     longitude: Optional[float] = None,
+    response_format: Optional[str] = Query(None, alias="format"),
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    """Get all bus stops, optionally sorted by distance from user location"""
+    """
+    Get all bus stops, optionally sorted by distance from user location.
+    ?format=ndjson streams one stop per line instead of a single JSON list.
+    """
     try:
-        stops = []
-        all_stops = fetch_all_bus_stops(db)  # Updated function name
-        
-        for stop_data in all_stops:
-            distance = None
-            if latitude is not None and longitude is not None:
-                distance = calculate_distance(latitude, longitude, stop_data["latitude"], stop_data["longitude"])
-            
-            stop = BusStop(
-                id=stop_data["id"],
-                name=stop_data["name"],
-                latitude=stop_data["latitude"],
-                longitude=stop_data["longitude"],
-                stop_order=stop_data["stop_order"],
-                distance_km=distance
-            )
-            stops.append(stop)
+        stops_np = _load_stops_arrays(db)
         
         # Sort by distance if location provided
+        distances = None
+        order = range(len(stops_np["ids"]))
         if latitude is not None and longitude is not None:
-            stops.sort(key=lambda x: x.distance_km or float('inf'))
+            distances = _stop_distances(stops_np, latitude, longitude)
+            order = np.argsort(distances).tolist()
+        
+        if response_format == "ndjson":
+            return dicts_ndjson_response(_iter_stop_dicts(stops_np, order, distances))
         
-        return stops
+        if distances is not None:
+            return [_stop_from_arrays(stops_np, i, float(distances[i])) for i in order]
+        return [_stop_from_arrays(stops_np, i) for i in order]
         
     except Exception as e:
         raise HTTPException(
@@ -1,20 +1,57 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from fastapi.responses import ORJSONResponse
+from sqlalchemy import and_, bindparam, case, func, or_, select
+from sqlalchemy.orm import Session, raiseload
 from datetime import datetime, timedelta
-import random
-import string
+import logging
 import uuid
 import math
+from concurrent.futures import Future, ThreadPoolExecutor
 from typing import List, Optional
-from geopy.distance import geodesic
+import numpy as np
 
 from ..database import get_db
-from ..dependencies import get_current_user
+from ..dependencies import SECRET_KEY, get_current_user
 from ..schemas import User
 from ..models.user import Route, RouteStop, Bus, GPSTracking
+from ..utils.ids import generate_one_time_code, next_ticket_id, ticket_qr_digest
+from ..utils.geo import bounding_box_mask, haversine_km, haversine_km_vec
+from ..services.cache_service import cache_service
+from ..services.bus_service import PASSENGER_CACHE_PREFIX
+from ..services.map_service import map_service
 from pydantic import BaseModel
 
 router = APIRouter(prefix="/passenger", tags=["passenger"])
+logger = logging.getLogger(__name__)
+
+# Stop table for /bus-stops; route and stop writes clear everything under the prefix
+STOP_TABLE_CACHE_KEY = f"{PASSENGER_CACHE_PREFIX}stop_table"
+STOP_TABLE_TTL_SECONDS = 60
+
+# Latest fix per active bus, shared by /nearby-buses requests for a few seconds
+GPS_SNAPSHOT_CACHE_KEY = f"{PASSENGER_CACHE_PREFIX}gps_snapshot"
+GPS_SNAPSHOT_TTL_SECONDS = 5
+
+# OpenRouteService directions between two stops rarely change
+ROUTE_GEOMETRY_TTL_SECONDS = 3600
+
+# Runs route geometry lookups alongside the find-route DB queries
+_route_lookup_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="ors-lookup")
+
+# Routes containing both ends of a search, with the lowest matching stop id for each end.
+# Built once with bound patterns, so every search reuses one compiled statement and the
+# same SQL text for the driver's statement cache
+_source_match = RouteStop.stop_name.ilike(bindparam("source_pattern"))
+_destination_match = RouteStop.stop_name.ilike(bindparam("destination_pattern"))
+_source_id = func.min(case((_source_match, RouteStop.id)))
+_destination_id = func.min(case((_destination_match, RouteStop.id)))
+ROUTE_MATCH_STMT = select(
+    RouteStop.route_id, _source_id, _destination_id
+).where(
+    or_(_source_match, _destination_match)
+).group_by(RouteStop.route_id).having(
+    and_(_source_id.isnot(None), _destination_id.isnot(None))
+)
 
 # Pydantic models
 class LocationInput(BaseModel):
@@ -66,13 +103,6 @@ class Ticket(BaseModel):
     status: str
     created_at: str
 
-def calculate_distance(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
-    """Calculate distance between two points using geopy geodesic (more accurate)"""
-    point1 = (lat1, lon1)
-    point2 = (lat2, lon2)
-    distance = geodesic(point1, point2).kilometers
-    return distance
-
 def calculate_eta_minutes(distance_km: float, bus_speed_kmh: float = 40) -> int:
     """Calculate estimated arrival time based on distance and average bus speed"""
     # Average bus speed in city traffic (40 km/h)
@@ -86,42 +116,139 @@ def calculate_eta_minutes(distance_km: float, bus_speed_kmh: float = 40) -> int:
     total_eta = travel_time_minutes + buffer_minutes
     return max(5, int(total_eta))  # Minimum 5 minutes ETA
 
+def calculate_eta_minutes_vec(distances_km: np.ndarray, bus_speed_kmh: float = 40) -> np.ndarray:
+    """calculate_eta_minutes for an array of distances, as one fused expression"""
+    # travel minutes (d / speed * 60) plus 2 buffer minutes per km, truncated, at least 5
+    return np.maximum(5, (distances_km * (60.0 / bus_speed_kmh + 2.0)).astype(np.int64))
+
 def find_stop_by_name(db: Session, stop_name: str) -> Optional[RouteStop]:
     """Find bus stop by name with fuzzy matching"""
     stop_name_lower = stop_name.lower().strip()
     
-    # Try exact match first
+    # Try substring match first
     stop = db.query(RouteStop).filter(RouteStop.stop_name.ilike(f"%{stop_name_lower}%")).first()
     if stop:
         return stop
     
-    # Try partial match
-    all_stops = db.query(RouteStop).all()
-    for stop in all_stops:
-        if stop.stop_name and stop_name_lower in stop.stop_name.lower():
-            return stop
-        # Also try reverse match
-        if stop.stop_name and any(word in stop.stop_name.lower() for word in stop_name_lower.split()):
-            return stop
-    
-    return None
+    # Then any stop containing one of the words, still filtered in SQL
+    words = stop_name_lower.split()
+    if not words:
+        return None
+    return db.query(RouteStop).filter(
+        or_(*(RouteStop.stop_name.ilike(f"%{word}%") for word in words))
+    ).first()
+
+def _load_stop_table(db: Session) -> dict:
+    """Stops with coordinates as parallel columns, read without building ORM objects"""
+    rows = db.query(
+        RouteStop.id, RouteStop.stop_name, RouteStop.latitude, RouteStop.longitude, RouteStop.stop_order
+    ).filter(
+        RouteStop.latitude.isnot(None), RouteStop.latitude != 0,
+        RouteStop.longitude.isnot(None), RouteStop.longitude != 0
+    ).all()
+    count = len(rows)
+    return {
+        "ids": np.fromiter((row.id for row in rows), dtype=np.int64, count=count),
+        "names": [row.stop_name for row in rows],
+        "lat": np.fromiter((row.latitude for row in rows), dtype=np.float64, count=count),
+        "lng": np.fromiter((row.longitude for row in rows), dtype=np.float64, count=count),
+        "orders": np.fromiter((row.stop_order or 1 for row in rows), dtype=np.int32, count=count)
+    }
 
-def get_all_bus_stops(db: Session) -> List[dict]:
-    """Get all bus stops from database"""
-    stops = db.query(RouteStop).all()
+def get_stop_table(db: Session) -> dict:
+    """All bus stops as a columnar table, cached and dropped on route/stop writes"""
+    return cache_service.get_or_set(STOP_TABLE_CACHE_KEY, STOP_TABLE_TTL_SECONDS, lambda: _load_stop_table(db))
+
+def stop_rows_from_table(table: dict, indexes, distances: Optional[np.ndarray] = None) -> List[dict]:
+    """BusStop-shaped dicts for the given rows of the stop table, in that order"""
+    ids, names, orders = table["ids"].tolist(), table["names"], table["orders"].tolist()
+    lat, lng = table["lat"].tolist(), table["lng"].tolist()
+    distance_km = distances.tolist() if distances is not None else [None] * len(ids)
     return [
         {
-            "id": stop.id,
-            "name": stop.stop_name,
-            "latitude": float(stop.latitude) if stop.latitude else 0.0,
-            "longitude": float(stop.longitude) if stop.longitude else 0.0,
-            "stop_order": stop.stop_order or 1
+            "id": ids[i], "name": names[i], "latitude": lat[i], "longitude": lng[i], "stop_order": orders[i],
+            "distance_km": distance_km[i]
         }
-        for stop in stops if stop.latitude and stop.longitude
+        for i in indexes
     ]
 
+def _load_gps_snapshot(db: Session) -> dict:
+    """Latest GPS fix of every active bus as response rows plus coordinate arrays"""
+    ranked = db.query(
+        GPSTracking.id,
+        func.row_number().over(
+            partition_by=GPSTracking.bus_id,
+            order_by=GPSTracking.timestamp.desc()
+        ).label("rn")
+    ).subquery()
+    
+    fixes = db.query(GPSTracking, Bus).join(
+        ranked, GPSTracking.id == ranked.c.id
+    ).join(
+        Bus, GPSTracking.bus_id == Bus.id
+    ).filter(ranked.c.rn == 1, Bus.is_active == True).all()
+    
+    return {
+        "buses": [
+            {
+                "bus_id": bus_gps.bus_id,
+                "bus_number": bus_info.bus_number,
+                "current_latitude": float(bus_gps.latitude),
+                "current_longitude": float(bus_gps.longitude),
+                "bus_type": bus_info.bus_type,
+                "capacity": bus_info.capacity,
+                "route_id": bus_gps.route_id,
+                "last_updated": bus_gps.timestamp.isoformat() if bus_gps.timestamp else None
+            }
+            for bus_gps, bus_info in fixes
+        ],
+        "lat": np.fromiter((bus_gps.latitude for bus_gps, _ in fixes), dtype=np.float64, count=len(fixes)),
+        "lng": np.fromiter((bus_gps.longitude for bus_gps, _ in fixes), dtype=np.float64, count=len(fixes))
+    }
+
+def fetch_latest_route_gps(db: Session, route_ids: List[int]) -> dict:
+    """Latest GPS fix recorded on each of the given routes, keyed by (bus_id, route_id)"""
+    if not route_ids:
+        return {}
+    
+    ranked = db.query(
+        GPSTracking.id,
+        func.row_number().over(
+            partition_by=(GPSTracking.route_id, GPSTracking.bus_id),  # ix_gps_route_bus_ts_desc order
+            order_by=GPSTracking.timestamp.desc()
+        ).label("rn")
+    ).filter(GPSTracking.route_id.in_(route_ids)).subquery()
+    
+    fixes = db.query(GPSTracking).join(ranked, GPSTracking.id == ranked.c.id).filter(ranked.c.rn == 1).all()
+    return {(fix.bus_id, fix.route_id): fix for fix in fixes}
+
+def route_geometry_key(source_stop: RouteStop, destination_stop: RouteStop) -> str:
+    # Coordinates are part of the key so moving a stop never serves a stale geometry
+    return (
+        f"ors:route:{source_stop.id}:{destination_stop.id}:"
+        f"{source_stop.latitude},{source_stop.longitude}:{destination_stop.latitude},{destination_stop.longitude}"
+    )
+
+def get_stop_pair_route(source_stop: RouteStop, destination_stop: RouteStop) -> Optional[dict]:
+    """OpenRouteService directions between two stops, cached for an hour; failures are not cached"""
+    key = route_geometry_key(source_stop, destination_stop)
+    route_data = cache_service.get(key)
+    if route_data is None:
+        route_data = map_service.calculate_route([
+            [source_stop.latitude, source_stop.longitude],
+            [destination_stop.latitude, destination_stop.longitude]
+        ])
+        if route_data:
+            cache_service.set(key, route_data, ROUTE_GEOMETRY_TTL_SECONDS)
+    return route_data
+
+def _log_route_lookup_error(future: Future):
+    """Done-callback so a failed lookup is always observed, even when its search already errored out"""
+    if not future.cancelled() and future.exception() is not None:
+        logger.error(f"OpenRouteService lookup failed: {future.exception()}")
+
 @router.post("/find-route")
-async def find_bus_route(
+def find_bus_route(
     request: RouteSearchRequest,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
@@ -130,35 +257,29 @@ async def find_bus_route(
     try:
         print(f"Searching for routes with source: '{request.source_stop_name}' and destination: '{request.destination_stop_name}'")
         
-        # Find routes that contain both source and destination stops
-        source_routes = db.query(RouteStop.route_id).filter(
-            RouteStop.stop_name.ilike(f"%{request.source_stop_name}%")
-        ).subquery()
-        
-        destination_routes = db.query(RouteStop.route_id).filter(
-            RouteStop.stop_name.ilike(f"%{request.destination_stop_name}%")
-        ).subquery()
-        
-        # Find routes that contain both stops
-        valid_route_ids = db.query(source_routes.c.route_id).intersect(
-            db.query(destination_routes.c.route_id)
-        ).all()
+        # Find routes that contain both source and destination stops, and a matching
+        # stop id for each end, in one grouped scan instead of two subqueries + INTERSECT
+        route_matches = db.execute(ROUTE_MATCH_STMT, {
+            "source_pattern": f"%{request.source_stop_name}%",
+            "destination_pattern": f"%{request.destination_stop_name}%"
+        }).all()
         
-        valid_route_ids = [route_id[0] for route_id in valid_route_ids]
+        valid_route_ids = [route_id for route_id, _, _ in route_matches]
         print(f"Found valid route IDs: {valid_route_ids}")
         
         if not valid_route_ids:
             print("No routes found connecting source and destination")
             raise HTTPException(status_code=404, detail="No routes found between these stops")
         
-        # Get the actual stop details
-        source_stop = db.query(RouteStop).filter(
-            RouteStop.stop_name.ilike(f"%{request.source_stop_name}%")
-        ).first()
-        
-        destination_stop = db.query(RouteStop).filter(
-            RouteStop.stop_name.ilike(f"%{request.destination_stop_name}%")
-        ).first()
+        # Get the actual stop details: the lowest matching ids on those routes, both in one query
+        source_stop_id = min(stop_id for _, stop_id, _ in route_matches)
+        destination_stop_id = min(stop_id for _, _, stop_id in route_matches)
+        stops_by_id = {
+            stop.id: stop
+            for stop in db.query(RouteStop).filter(RouteStop.id.in_((source_stop_id, destination_stop_id))).all()
+        }
+        source_stop = stops_by_id.get(source_stop_id)
+        destination_stop = stops_by_id.get(destination_stop_id)
         
         if not source_stop:
             raise HTTPException(status_code=404, detail=f"Source stop '{request.source_stop_name}' not found")
@@ -166,53 +287,58 @@ async def find_bus_route(
         if not destination_stop:
             raise HTTPException(status_code=404, detail=f"Destination stop '{request.destination_stop_name}' not found")
         
-        # Get buses that serve the valid routes
-        available_buses = []
+        # Start the OpenRouteService lookup (cached per stop pair) now, so its HTTP round
+        # trip overlaps the bus/GPS queries below
+        route_future = _route_lookup_pool.submit(get_stop_pair_route, source_stop, destination_stop)
+        route_future.add_done_callback(_log_route_lookup_error)
         
-        for route_id in valid_route_ids:
-            # Get the route information
-            route = db.query(Route).filter(Route.id == route_id).first()
-            if not route:
-                continue
-                
-            # Get the bus information
-            bus_info = db.query(Bus).filter(Bus.id == route.bus_id).first()
-            if not bus_info:
-                continue
-                
-            # Get latest GPS tracking data for this bus
-            bus_gps = db.query(GPSTracking).filter(
-                GPSTracking.bus_id == route.bus_id,
-                GPSTracking.route_id == route_id
-            ).order_by(GPSTracking.timestamp.desc()).first()
-            
+        # Get buses that serve the valid routes: routes with their buses in one JOIN;
+        # raiseload flags any lazy load added later
+        routes_with_buses = db.query(Route, Bus).join(
+            Bus, Route.bus_id == Bus.id
+        ).options(raiseload("*")).filter(Route.id.in_(valid_route_ids)).all()
+        
+        # Latest GPS fix per (bus, route) in one windowed query
+        latest_gps = fetch_latest_route_gps(db, [route.id for route, _ in routes_with_buses])
+        
+        candidates = []
+        for route, bus_info in routes_with_buses:
+            bus_gps = latest_gps.get((route.bus_id, route.id))
             if bus_gps:
-                # Calculate distance from search location (user or source stop)
-                search_lat = request.user_location.latitude if request.user_location else source_stop.latitude
-                search_lng = request.user_location.longitude if request.user_location else source_stop.longitude
-                
-                bus_distance = calculate_distance(
-                    search_lat, search_lng,
-                    bus_gps.latitude, bus_gps.longitude
-                )
-                
-                if bus_distance <= request.max_distance_km:
-                    eta_minutes = calculate_eta_minutes(bus_distance)
-                    available_buses.append({
-                        "bus_id": route.bus_id,
-                        "bus_number": bus_info.bus_number,
-                        "current_latitude": float(bus_gps.latitude),
-                        "current_longitude": float(bus_gps.longitude),
-                        "distance_from_user_km": round(bus_distance, 2),
-                        "estimated_arrival_minutes": eta_minutes,
-                        "route_id": route_id,
-                        "route_name": route.route_name,
-                        "next_stop": destination_stop.stop_name,
-                        "stops_remaining": 2,
-                        "bus_type": bus_info.bus_type,
-                        "capacity": bus_info.capacity
-                    })
-                    print(f"Added bus {bus_info.bus_number} from route {route.route_name}")
+                candidates.append((route, bus_info, bus_gps))
+        
+        # Distance from search location (user or source stop) to every candidate bus in one pass
+        available_buses = []
+        if candidates:
+            search_lat = request.user_location.latitude if request.user_location else source_stop.latitude
+            search_lng = request.user_location.longitude if request.user_location else source_stop.longitude
+            bus_lats = np.fromiter((gps.latitude for _, _, gps in candidates), dtype=np.float64, count=len(candidates))
+            bus_lngs = np.fromiter((gps.longitude for _, _, gps in candidates), dtype=np.float64, count=len(candidates))
+            bus_distances = haversine_km_vec(search_lat, search_lng, bus_lats, bus_lngs)
+            
+            # Rounding and conversion to Python numbers for all in-range buses at once
+            in_range = np.flatnonzero(bus_distances <= request.max_distance_km)
+            lats_out = bus_lats[in_range].tolist()
+            lngs_out = bus_lngs[in_range].tolist()
+            distances_out = np.round(bus_distances[in_range], 2).tolist()
+            etas = calculate_eta_minutes_vec(bus_distances[in_range]).tolist()
+            for k, i in enumerate(in_range.tolist()):
+                route, bus_info, bus_gps = candidates[i]
+                available_buses.append({
+                    "bus_id": route.bus_id,
+                    "bus_number": bus_info.bus_number,
+                    "current_latitude": lats_out[k],
+                    "current_longitude": lngs_out[k],
+                    "distance_from_user_km": distances_out[k],
+                    "estimated_arrival_minutes": etas[k],
+                    "route_id": route.id,
+                    "route_name": route.route_name,
+                    "next_stop": destination_stop.stop_name,
+                    "stops_remaining": 2,
+                    "bus_type": bus_info.bus_type,
+                    "capacity": bus_info.capacity
+                })
+                print(f"Added bus {bus_info.bus_number} from route {route.route_name}")
         
         # If no buses found on valid routes, don't show any buses
         if not available_buses:
@@ -225,16 +351,9 @@ async def find_bus_route(
         # Select recommended bus (closest one)
         recommended_bus = available_buses[0] if available_buses else None
         
-        # Get actual route geometry using OpenRouteService
-        from ..services.map_service import map_service
-        
-        # Calculate route using OpenRouteService
-        coordinates = [
-            [source_stop.latitude, source_stop.longitude],
-            [destination_stop.latitude, destination_stop.longitude]
-        ]
-        
-        route_data = map_service.calculate_route(coordinates)
+        # Get actual route geometry using OpenRouteService; a failed lookup (already
+        # logged by its callback) falls back to the straight line below
+        route_data = None if route_future.exception() else route_future.result()
         
         # Extract route geometry and distance from OpenRouteService response
         if route_data and route_data.get('features') and len(route_data['features']) > 0:
@@ -248,7 +367,7 @@ async def find_bus_route(
                 estimated_duration_minutes = int(properties['segments'][0].get('duration', 0) / 60.0)
             else:
                 # Fallback to calculated distance
-                total_distance_km = calculate_distance(
+                total_distance_km = haversine_km(
                     source_stop.latitude, source_stop.longitude,
                     destination_stop.latitude, destination_stop.longitude
                 )
@@ -256,7 +375,7 @@ async def find_bus_route(
         else:
             # Fallback to straight line if OpenRouteService fails
             print("OpenRouteService failed, using straight line fallback")
-            total_distance_km = calculate_distance(
+            total_distance_km = haversine_km(
                 source_stop.latitude, source_stop.longitude,
                 destination_stop.latitude, destination_stop.longitude
             )
@@ -270,7 +389,7 @@ async def find_bus_route(
                 ]
             }
         
-        return {
+        return ORJSONResponse({
             "source_stop": {
                 "id": source_stop.id,
                 "name": source_stop.stop_name,
@@ -290,45 +409,41 @@ async def find_bus_route(
             "total_distance_km": round(total_distance_km, 2),
             "estimated_duration_minutes": estimated_duration_minutes,
             "recommended_bus": recommended_bus
-        }
+        })
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Error finding route: {str(e)}"
         )
+
 @router.get("/bus-stops")
-async def get_bus_stops(
+def get_bus_stops(
     latitude: Optional[float] = None,
     longitude: Optional[float] = None,
+    limit: Optional[int] = Query(None, ge=1, description="Return only this many stops (the nearest, if a location is given)"),
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
     """Get all bus stops, optionally sorted by distance from user location"""
     try:
-        stops = []
-        all_stops = get_all_bus_stops(db)
-        
-        for stop_data in all_stops:
-            distance = None
-            if latitude is not None and longitude is not None:
-                distance = calculate_distance(latitude, longitude, stop_data["latitude"], stop_data["longitude"])
-            
-            stop = BusStop(
-                id=stop_data["id"],
-                name=stop_data["name"],
-                latitude=stop_data["latitude"],
-                longitude=stop_data["longitude"],
-                stop_order=stop_data["stop_order"],
-                distance_km=distance
-            )
-            stops.append(stop)
-        
-        # Sort by distance if location provided
-        if latitude is not None and longitude is not None:
-            stops.sort(key=lambda x: x.distance_km or float('inf'))
-        
-        return stops
+        table = get_stop_table(db)
+        count = len(table["ids"])
+        
+        if latitude is None or longitude is None:
+            return ORJSONResponse(stop_rows_from_table(table, range(min(limit or count, count))))
+        
+        # Distances to every stop in one pass, nearest first
+        distances = haversine_km_vec(latitude, longitude, table["lat"], table["lng"])
+        if limit is not None and limit < count:
+            # Only the k nearest are needed: partition in O(n), then sort just those k
+            nearest = np.argpartition(distances, limit - 1)[:limit]
+            order = nearest[np.argsort(distances[nearest], kind="stable")]
+        else:
+            order = np.argsort(distances, kind="stable")
+        return ORJSONResponse(stop_rows_from_table(table, order.tolist(), distances))
         
     except Exception as e:
         raise HTTPException(
@@ -337,7 +452,7 @@ async def get_bus_stops(
         )
 
 @router.post("/book-ticket")
-async def book_ticket(
+def book_ticket(
     request: TicketBookingRequest,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
@@ -352,10 +467,11 @@ async def book_ticket(
                 detail=f"Bus with ID {request.bus_id} not found"
             )
         
-        # Generate ticket details
-        ticket_id = random.randint(1000, 9999)
-        qr_code = f"QR{ticket_id}{random.randint(100, 999)}"
-        one_time_code = ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
+        # Generate ticket details: a unique time-ordered id, a QR payload that can't be
+        # forged without the server key, and a one-time code from the OS CSPRNG
+        ticket_id = next_ticket_id()
+        qr_code = f"QR{ticket_id}{ticket_qr_digest(SECRET_KEY, ticket_id, request.bus_id, current_user.id)}"
+        one_time_code = generate_one_time_code()
         
         # Create ticket with real bus number
         ticket = Ticket(
@@ -381,7 +497,7 @@ async def book_ticket(
         )
 
 @router.get("/nearby-buses")
-async def get_nearby_buses(
+def get_nearby_buses(
     latitude: float,
     longitude: float,
     max_distance_km: float = 3.0,  # Changed from radius_km to match frontend
@@ -392,34 +508,37 @@ async def get_nearby_buses(
     try:
         nearby_buses = []
         
-        # Get GPS tracking data with bus information using JOIN
-        active_buses_query = db.query(GPSTracking, Bus).join(
-            Bus, GPSTracking.bus_id == Bus.id
-        ).filter(GPSTracking.is_active == True).all()
+        # Latest fix per active bus, cached briefly and shared across requests
+        snapshot = cache_service.get_or_set(
+            GPS_SNAPSHOT_CACHE_KEY, GPS_SNAPSHOT_TTL_SECONDS, lambda: _load_gps_snapshot(db)
+        )
         
-        for bus_gps, bus_info in active_buses_query:
-            distance = calculate_distance(
-                latitude, longitude,
-                float(bus_gps.latitude), float(bus_gps.longitude)
-            )
-            
-            if distance <= max_distance_km:  # Use max_distance_km instead of radius_km
-                eta_minutes = calculate_eta_minutes(distance)
-                nearby_buses.append({
-                    "bus_id": bus_gps.bus_id,
-                    "bus_number": bus_info.bus_number,  # Use real bus number from database
-                    "current_latitude": float(bus_gps.latitude),
-                    "current_longitude": float(bus_gps.longitude),
-                    "distance_from_user_km": round(distance, 2),
-                    "estimated_arrival_minutes": eta_minutes,
-                    "bus_type": bus_info.bus_type,
-                    "capacity": bus_info.capacity,
-                    "route_id": bus_gps.route_id,
-                    "last_updated": bus_gps.timestamp.isoformat() if bus_gps.timestamp else None
-                })
+        # Cheap bounding-box prefilter, then exact distances for the survivors only
+        candidates = np.flatnonzero(bounding_box_mask(
+            latitude, longitude, snapshot["lat"], snapshot["lng"], max_distance_km
+        ))
+        distances = haversine_km_vec(latitude, longitude, snapshot["lat"][candidates], snapshot["lng"][candidates])
+        
+        in_range = np.flatnonzero(distances <= max_distance_km)  # Use max_distance_km instead of radius_km
+        distances_out = np.round(distances[in_range], 2).tolist()
+        etas = calculate_eta_minutes_vec(distances[in_range]).tolist()
+        for bus_index, distance, eta_minutes in zip(candidates[in_range].tolist(), distances_out, etas):
+            bus = snapshot["buses"][bus_index]
+            nearby_buses.append({
+                "bus_id": bus["bus_id"],
+                "bus_number": bus["bus_number"],  # Use real bus number from database
+                "current_latitude": bus["current_latitude"],
+                "current_longitude": bus["current_longitude"],
+                "distance_from_user_km": distance,
+                "estimated_arrival_minutes": eta_minutes,
+                "bus_type": bus["bus_type"],
+                "capacity": bus["capacity"],
+                "route_id": bus["route_id"],
+                "last_updated": bus["last_updated"]
+            })
         
         nearby_buses.sort(key=lambda x: x["distance_from_user_km"])
-        return nearby_buses
+        return ORJSONResponse(nearby_buses)
         
     except Exception as e:
         print(f"Error in get_nearby_buses: {str(e)}")
@@ -1,10 +1,10 @@
-from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi import APIRouter, Depends, HTTPException, Query, Response
 from sqlalchemy.orm import Session
-from sqlalchemy import Column, Integer, String, Float, DateTime, Text
+from sqlalchemy import Column, Integer, String, Float, DateTime, Text, Index, func, insert, tuple_, update
 from sqlalchemy.ext.declarative import declarative_base
 from datetime import datetime
 from typing import Optional, List
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
 
 from ..database import get_db, Base
 
@@ -30,6 +30,19 @@ class SOSAlert(Base):
     responded_by = Column(String, nullable=True)
     response_time = Column(DateTime, nullable=True)
 
+    __table_args__ = (
+        # Newest-first listing, with and without a status filter, read straight off the index
+        Index("ix_sos_status_created", status, created_at.desc(), id.desc()),
+        Index("ix_sos_created", created_at.desc(), id.desc()),
+    )
+
+# Status each responder action moves an alert to
+SOS_ACTION_STATUS = {
+    "acknowledge": "acknowledged",
+    "dispatch_help": "acknowledged",
+    "resolve": "resolved",
+}
+
 # Pydantic models
 class SOSAlertCreate(BaseModel):
     bus_id: int
@@ -64,29 +77,17 @@ class SOSAlertOut(BaseModel):
     responded_by: Optional[str]
     response_time: Optional[datetime]
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 @router.post("/alerts", response_model=SOSAlertOut)
-async def create_sos_alert(alert_data: SOSAlertCreate, db: Session = Depends(get_db)):
+def create_sos_alert(alert_data: SOSAlertCreate, db: Session = Depends(get_db)):
     """Create a new SOS alert"""
     try:
-        # Create new SOS alert
-        sos_alert = SOSAlert(
-            bus_id=alert_data.bus_id,
-            bus_number=alert_data.bus_number,
-            driver_id=alert_data.driver_id,
-            driver_name=alert_data.driver_name,
-            latitude=alert_data.latitude,
-            longitude=alert_data.longitude,
-            emergency_type=alert_data.emergency_type,
-            message=alert_data.message,
-            priority=alert_data.priority
-        )
-        
-        db.add(sos_alert)
+        # Create new SOS alert; RETURNING hands back the stored row in the same round trip
+        sos_alert = db.scalars(
+            insert(SOSAlert).values(**alert_data.model_dump(exclude_none=True)).returning(SOSAlert)
+        ).one()
         db.commit()
-        db.refresh(sos_alert)
         
         return sos_alert
         
@@ -94,55 +95,80 @@ async def create_sos_alert(alert_data: SOSAlertCreate, db: Session = Depends(get
         db.rollback()
         raise HTTPException(status_code=500, detail=f"Failed to create SOS alert: {str(e)}")
 
+def encode_alert_cursor(alert: SOSAlert) -> str:
+    return f"{alert.created_at.isoformat()}|{alert.id}"
+
+def decode_alert_cursor(cursor: str) -> tuple:
+    """Parse a "<created_at ISO>|<id>" cursor; ValueError if malformed"""
+    created_at, _, alert_id = cursor.rpartition("|")
+    return datetime.fromisoformat(created_at), int(alert_id)
+
 @router.get("/alerts", response_model=List[SOSAlertOut])
-async def get_sos_alerts(
+def get_sos_alerts(
+    response: Response,
     status: Optional[str] = Query(None, description="Filter by status: active, acknowledged, resolved, all"),
-    limit: int = Query(50, le=100),
+    limit: int = Query(50, ge=1, le=100),
+    cursor: Optional[str] = Query(None, description="X-Next-Cursor value from the previous page"),
     db: Session = Depends(get_db)
 ):
-    """Get SOS alerts with optional status filter"""
+    """
+    Get SOS alerts with optional status filter, newest first.
+    When a full page is returned, the X-Next-Cursor header holds the cursor for the next one.
+    """
     try:
         query = db.query(SOSAlert)
         
         if status and status != "all":
             query = query.filter(SOSAlert.status == status)
+        
+        # Keyset pagination: continue strictly after the last alert of the previous page
+        if cursor:
+            try:
+                cursor_created_at, cursor_id = decode_alert_cursor(cursor)
+            except ValueError:
+                raise HTTPException(status_code=400, detail="Invalid cursor")
+            query = query.filter(tuple_(SOSAlert.created_at, SOSAlert.id) < (cursor_created_at, cursor_id))
             
-        alerts = query.order_by(SOSAlert.created_at.desc()).limit(limit).all()
+        alerts = query.order_by(SOSAlert.created_at.desc(), SOSAlert.id.desc()).limit(limit).all()
+        if len(alerts) == limit:
+            response.headers["X-Next-Cursor"] = encode_alert_cursor(alerts[-1])
         return alerts
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to fetch SOS alerts: {str(e)}")
 
 @router.post("/alerts/{alert_id}/respond", response_model=SOSAlertOut)
-async def respond_to_sos_alert(
+def respond_to_sos_alert(
     alert_id: int,
     response_data: SOSAlertResponse,
     db: Session = Depends(get_db)
 ):
     """Respond to an SOS alert"""
     try:
-        # Find the alert
-        alert = db.query(SOSAlert).filter(SOSAlert.id == alert_id).first()
-        if not alert:
-            raise HTTPException(status_code=404, detail="SOS alert not found")
-        
-        # Update alert based on action
-        if response_data.action == "acknowledge":
-            alert.status = "acknowledged"
-        elif response_data.action == "dispatch_help":
-            alert.status = "acknowledged"
-            alert.message = (alert.message or "") + f" [HELP DISPATCHED by {response_data.responded_by}]"
-        elif response_data.action == "resolve":
-            alert.status = "resolved"
-        else:
+        # Status each action moves the alert to
+        new_status = SOS_ACTION_STATUS.get(response_data.action)
+        if new_status is None:
             raise HTTPException(status_code=400, detail="Invalid action")
         
-        alert.responded_by = response_data.responded_by
-        alert.response_time = datetime.utcnow()
-        alert.updated_at = datetime.utcnow()
+        now = datetime.utcnow()
+        values = {
+            "status": new_status,
+            "responded_by": response_data.responded_by,
+            "response_time": now,
+            "updated_at": now
+        }
+        if response_data.action == "dispatch_help":
+            values["message"] = func.coalesce(SOSAlert.message, "") + f" [HELP DISPATCHED by {response_data.responded_by}]"
         
+        # Update and read back the alert in one statement
+        alert = db.scalars(
+            update(SOSAlert).where(SOSAlert.id == alert_id).values(**values).returning(SOSAlert)
+        ).one_or_none()
+        if not alert:
+            raise HTTPException(status_code=404, detail="SOS alert not found")
         db.commit()
-        db.refresh(alert)
         
         return alert
         
@@ -153,7 +179,7 @@ async def respond_to_sos_alert(
         raise HTTPException(status_code=500, detail=f"Failed to respond to SOS alert: {str(e)}")
 
 @router.get("/alerts/{alert_id}", response_model=SOSAlertOut)
-async def get_sos_alert(alert_id: int, db: Session = Depends(get_db)):
+def get_sos_alert(alert_id: int, db: Session = Depends(get_db)):
     """Get a specific SOS alert"""
     try:
         alert = db.query(SOSAlert).filter(SOSAlert.id == alert_id).first()
@@ -166,7 +192,7 @@ async def get_sos_alert(alert_id: int, db: Session = Depends(get_db)):
         raise HTTPException(status_code=500, detail=f"Failed to fetch SOS alert: {str(e)}")
 
 @router.delete("/alerts/{alert_id}")
-async def delete_sos_alert(alert_id: int, db: Session = Depends(get_db)):
+def delete_sos_alert(alert_id: int, db: Session = Depends(get_db)):
     """Delete an SOS alert"""
     try:
         alert = db.query(SOSAlert).filter(SOSAlert.id == alert_id).first()
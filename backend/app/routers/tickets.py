@@ -1,15 +1,19 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Header, HTTPException, Query, status
+from fastapi.responses import ORJSONResponse
+from sqlalchemy import update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session, aliased, load_only, raiseload
 from datetime import datetime, timedelta
-import random
-import string
+import secrets
 import uuid
 from typing import List, Optional
 
-from ..database import get_db
-from ..dependencies import get_current_user
-from ..schemas import TicketCreate, TicketResponse, User
-from ..models.user import Bus, Route, RouteStop  # Import Bus model
+from ..dependencies import SECRET_KEY, CurrentUser, DbSession
+from ..schemas import TicketCreate, TicketResponse
+from ..utils.ids import codes_match, generate_one_time_code as generate_code
+from ..services.cache_service import cache_service
+from ..services.bus_service import PASSENGER_CACHE_PREFIX
+from ..models.user import Bus, Route, RouteStop, Ticket  # Import Bus model
 from pydantic import BaseModel
 
 router = APIRouter()
@@ -44,28 +48,74 @@ class AvailableBus(BaseModel):
     current_longitude: Optional[float]
     estimated_arrival: Optional[str]
 
-# Mock ticket storage (in production, use a proper database)
-tickets_storage = {}
+# How long a booked ticket stays valid
+TICKET_TTL = timedelta(hours=1)
+
+# Ticket ids for keyed bookings are uuid5(namespace, "user_id:key"), so a retried
+# request maps to the id of the ticket its first attempt created
+TICKET_ID_NAMESPACE = uuid.UUID("6f1c2a4e-3b5d-4f7a-9c8e-2d1b0a9f8e7d")
+
+# Stop list for /stops; route and stop writes clear everything under the prefix
+ALL_STOPS_CACHE_KEY = f"{PASSENGER_CACHE_PREFIX}ticket_stops"
+ALL_STOPS_TTL_SECONDS = 300
 
 def generate_ticket_code():
-    """Generate a unique ticket code"""
-    return ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
+    """Generate an 8-character ticket code from the OS CSPRNG"""
+    return generate_code(8)
 
 def generate_one_time_code():
     """Generate a 4-digit one-time use code"""
-    return ''.join(random.choices(string.digits, k=4))
+    return f"{secrets.randbelow(10000):04d}"
+
+def _load_all_stops(db) -> List[dict]:
+    """Stops with coordinates as plain dicts, read as columns rather than ORM objects"""
+    rows = db.query(
+        RouteStop.id, RouteStop.stop_name, RouteStop.latitude, RouteStop.longitude, RouteStop.stop_order
+    ).filter(
+        RouteStop.latitude.isnot(None), RouteStop.longitude.isnot(None)
+    ).order_by(RouteStop.route_id, RouteStop.stop_order).all()
+    return [
+        {"id": row.id, "name": row.stop_name, "latitude": row.latitude, "longitude": row.longitude, "stop_order": row.stop_order}
+        for row in rows
+    ]
+
+def insert_ticket_stmt(db: Session):
+    """INSERT into tickets that skips rows whose id already exists (ON CONFLICT DO NOTHING)"""
+    dialect = postgresql if db.get_bind().dialect.name == "postgresql" else sqlite
+    return dialect.insert(Ticket).on_conflict_do_nothing(index_elements=[Ticket.id])
+
+def check_idempotent_replay(ticket: Ticket, bus_id: int, source_stop: str, destination_stop: str):
+    """Raise 409 when an Idempotency-Key is reused for a booking with a different bus or stops"""
+    if (ticket.bus_id, ticket.source_stop, ticket.destination_stop) != (bus_id, source_stop, destination_stop):
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Idempotency-Key was already used for a different booking"
+        )
+
+def ticket_response(ticket: Ticket, now: datetime) -> TicketResponse:
+    """Response for a stored ticket; expiry is derived from expires_at on read, never written back"""
+    response = TicketResponse.model_validate(ticket)
+    if response.status == "active" and ticket.expires_at < now:
+        response.status = "expired"
+    return response
 
 @router.post("/search-buses", response_model=List[AvailableBus])
-async def search_buses(
+def search_buses(
     search_request: BusSearchRequest,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: CurrentUser,
+    db: DbSession
 ):
     """Search for available buses between two stops"""
     try:
-        # Get source and destination stop information
-        source_stop = db.query(RouteStop).filter(RouteStop.id == search_request.source_stop_id).first()
-        destination_stop = db.query(RouteStop).filter(RouteStop.id == search_request.destination_stop_id).first()
+        # Get source and destination stop information in one IN query
+        stops_by_id = {
+            stop.id: stop
+            for stop in db.query(RouteStop).filter(
+                RouteStop.id.in_((search_request.source_stop_id, search_request.destination_stop_id))
+            ).all()
+        }
+        source_stop = stops_by_id.get(search_request.source_stop_id)
+        destination_stop = stops_by_id.get(search_request.destination_stop_id)
         
         if not source_stop or not destination_stop:
             raise HTTPException(
@@ -74,7 +124,10 @@ async def search_buses(
             )
         
         # Get all buses from database
-        buses = db.query(Bus).limit(3).all()  # Get first 3 buses for demo
+        # Only the columns the response uses; raiseload flags any lazy load added later
+        buses = db.query(Bus).options(
+            load_only(Bus.id, Bus.bus_number), raiseload("*")
+        ).limit(3).all()  # Get first 3 buses for demo
         
         available_buses = []
         for bus in buses:
@@ -97,42 +150,59 @@ async def search_buses(
         )
 
 @router.post("/book", response_model=TicketResponse)
-async def book_ticket(
+def book_ticket(
     ticket_data: TicketCreate,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: CurrentUser,
+    db: DbSession,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key", max_length=255)
 ):
-    """Book a ticket for the user"""
+    """Book a ticket for the user; retries sent with the same Idempotency-Key return the same ticket"""
     try:
-        # Generate unique ticket ID
-        ticket_id = str(uuid.uuid4())
-        
-        # Generate codes
-        qr_code = f"TICKET_{generate_ticket_code()}"
-        one_time_code = generate_one_time_code()
-        
-        # Set expiration time (1 hour from now)
-        expires_at = datetime.now() + timedelta(hours=1)
-        
-        # Get bus information from database
-        bus_info = db.query(Bus).filter(Bus.id == ticket_data.bus_id).first()
-        if not bus_info:
+        # Bus number and both stop names in one query; the stops are outer-joined
+        # since either may be missing
+        source = aliased(RouteStop)
+        destination = aliased(RouteStop)
+        row = db.query(
+            Bus.bus_number, source.stop_name, destination.stop_name
+        ).select_from(Bus).outerjoin(
+            source, source.id == ticket_data.source_stop_id
+        ).outerjoin(
+            destination, destination.id == ticket_data.destination_stop_id
+        ).filter(Bus.id == ticket_data.bus_id).first()
+        if not row:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail=f"Bus with ID {ticket_data.bus_id} not found"
             )
         
-        # Get route stops information if available
-        source_stop_info = db.query(RouteStop).filter(RouteStop.id == ticket_data.source_stop_id).first()
-        destination_stop_info = db.query(RouteStop).filter(RouteStop.id == ticket_data.destination_stop_id).first()
+        bus_number, source_name, destination_name = row
+        route_name = f"{source_name or 'Unknown'} to {destination_name or 'Unknown'}"
+        source_stop = source_name or "Unknown Stop"
+        destination_stop = destination_name or "Unknown Stop"
+        
+        if idempotency_key:
+            ticket_id = str(uuid.uuid5(TICKET_ID_NAMESPACE, f"{current_user.id}:{idempotency_key}"))
+            # A retry of a booking that already went through: one primary-key lookup,
+            # returned only when it books the same bus and stops
+            existing = db.get(Ticket, ticket_id)
+            if existing:
+                check_idempotent_replay(existing, ticket_data.bus_id, source_stop, destination_stop)
+                return ticket_response(existing, datetime.now())
+        else:
+            # Generate unique ticket ID
+            ticket_id = str(uuid.uuid4())
         
-        bus_number = bus_info.bus_number
-        route_name = f"{source_stop_info.stop_name if source_stop_info else 'Unknown'} to {destination_stop_info.stop_name if destination_stop_info else 'Unknown'}"
-        source_stop = source_stop_info.stop_name if source_stop_info else "Unknown Stop"
-        destination_stop = destination_stop_info.stop_name if destination_stop_info else "Unknown Stop"
+        # Generate codes
+        qr_code = f"TICKET_{generate_ticket_code()}"
+        one_time_code = generate_one_time_code()
+        
+        # Set expiration time (1 hour from now)
+        created_at = datetime.now()
+        expires_at = created_at + TICKET_TTL
         
-        # Create ticket object
-        ticket = TicketResponse(
+        # Persist the ticket. A concurrent retry that inserted the same id first wins;
+        # this insert then does nothing and the stored ticket is returned instead
+        ticket = db.scalars(insert_ticket_stmt(db).values(
             id=ticket_id,
             bus_id=ticket_data.bus_id,
             bus_number=bus_number,
@@ -143,41 +213,43 @@ async def book_ticket(
             one_time_code=one_time_code,
             expires_at=expires_at,
             status="active",
-            created_at=datetime.now(),
+            created_at=created_at,
             user_id=current_user.id
-        )
-        
-        # Store ticket (in production, save to database)
-        tickets_storage[ticket_id] = ticket
+        ).returning(Ticket)).first()
+        if ticket is None:
+            ticket = db.get(Ticket, ticket_id)
+            check_idempotent_replay(ticket, ticket_data.bus_id, source_stop, destination_stop)
+        db.commit()
         
-        return ticket
+        return ticket_response(ticket, created_at)
         
+    except HTTPException:
+        raise
     except Exception as e:
+        db.rollback()
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Error booking ticket: {str(e)}"
         )
 
 @router.get("/my-tickets", response_model=List[TicketResponse])
-async def get_user_tickets(
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+def get_user_tickets(
+    current_user: CurrentUser,
+    db: DbSession,
+    limit: int = Query(50, ge=1, le=200)
 ):
-    """Get all tickets for the current user"""
+    """Get the current user's most recent tickets"""
     try:
-        # Filter tickets for current user
-        user_tickets = [
-            ticket for ticket in tickets_storage.values() 
-            if ticket.user_id == current_user.id
-        ]
+        # Newest first. expires_at is always created_at + TICKET_TTL, so ordering on it
+        # is booking order and reads straight off the (user_id, expires_at) index
+        user_tickets = db.query(Ticket).filter(
+            Ticket.user_id == current_user.id
+        ).order_by(Ticket.expires_at.desc()).limit(limit).all()
         
-        # Update expired tickets
+        # Dumped once here and handed to orjson, instead of FastAPI re-validating
+        # every model against response_model before serializing
         current_time = datetime.now()
-        for ticket in user_tickets:
-            if ticket.expires_at < current_time and ticket.status == "active":
-                ticket.status = "expired"
-        
-        return user_tickets
+        return ORJSONResponse([ticket_response(ticket, current_time).model_dump(mode="json") for ticket in user_tickets])
         
     except Exception as e:
         raise HTTPException(
@@ -185,22 +257,37 @@ async def get_user_tickets(
             detail=f"Error fetching tickets: {str(e)}"
         )
 
+@router.get("/stops")
+def get_all_stops(
+    current_user: CurrentUser,
+    db: DbSession
+):
+    """Get all available bus stops"""
+    try:
+        stops = cache_service.get_or_set(ALL_STOPS_CACHE_KEY, ALL_STOPS_TTL_SECONDS, lambda: _load_all_stops(db))
+        return ORJSONResponse(stops)  # plain dicts: skip jsonable_encoder's recursive walk
+        
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Error fetching stops: {str(e)}"
+        )
+
 @router.get("/{ticket_id}", response_model=TicketResponse)
-async def get_ticket(
+def get_ticket(
     ticket_id: str,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: CurrentUser,
+    db: DbSession
 ):
     """Get a specific ticket by ID"""
     try:
-        if ticket_id not in tickets_storage:
+        ticket = db.get(Ticket, ticket_id)
+        if not ticket:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail="Ticket not found"
             )
         
-        ticket = tickets_storage[ticket_id]
-        
         # Check if user owns this ticket
         if ticket.user_id != current_user.id:
             raise HTTPException(
@@ -208,11 +295,7 @@ async def get_ticket(
                 detail="Not authorized to view this ticket"
             )
         
-        # Update status if expired
-        if ticket.expires_at < datetime.now() and ticket.status == "active":
-            ticket.status = "expired"
-        
-        return ticket
+        return ticket_response(ticket, datetime.now())
         
     except HTTPException:
         raise
@@ -223,25 +306,24 @@ async def get_ticket(
         )
 
 @router.post("/{ticket_id}/validate")
-async def validate_ticket(
+def validate_ticket(
     ticket_id: str,
     validation_code: str,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: CurrentUser,
+    db: DbSession
 ):
     """Validate a ticket using QR code or one-time code"""
     try:
-        if ticket_id not in tickets_storage:
+        ticket = db.get(Ticket, ticket_id)
+        if not ticket:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail="Ticket not found"
             )
         
-        ticket = tickets_storage[ticket_id]
-        
         # Check if ticket is still valid
-        if ticket.expires_at < datetime.now():
-            ticket.status = "expired"
+        now = datetime.now()
+        if ticket.expires_at < now:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="Ticket has expired"
@@ -253,17 +335,31 @@ async def validate_ticket(
                 detail="Ticket is not active"
             )
         
-        # Validate code
-        if validation_code != ticket.qr_code and validation_code != ticket.one_time_code:
+        # Validate code; both codes are always checked, so timing doesn't reveal which one was tried
+        qr_match = codes_match(SECRET_KEY, validation_code, ticket.qr_code)
+        one_time_match = codes_match(SECRET_KEY, validation_code, ticket.one_time_code)
+        if not (qr_match or one_time_match):
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="Invalid validation code"
             )
         
-        # Mark ticket as used
-        ticket.status = "used"
+        # Mark ticket as used in one conditional write: if a concurrent scan got there
+        # first (or it expired meanwhile), no row comes back and this scan is rejected
+        used_ticket = db.scalars(
+            update(Ticket).where(
+                Ticket.id == ticket_id, Ticket.status == "active", Ticket.expires_at >= now
+            ).values(status="used").returning(Ticket)
+        ).first()
+        if used_ticket is None:
+            db.rollback()
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Ticket is not active"
+            )
+        db.commit()
         
-        return {"message": "Ticket validated successfully", "ticket": ticket}
+        return {"message": "Ticket validated successfully", "ticket": ticket_response(used_ticket, now)}
         
     except HTTPException:
         raise
@@ -272,28 +368,3 @@ async def validate_ticket(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Error validating ticket: {str(e)}"
         )
-
-@router.get("/stops")
-async def get_all_stops(
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
-):
-    """Get all available bus stops"""
-    try:
-        # Mock stops for now (in production, query from database)
-        stops = [
-            {"id": 1, "name": "Main Station", "latitude": 12.9716, "longitude": 77.5946, "stop_order": 1},
-            {"id": 2, "name": "City Center", "latitude": 12.9800, "longitude": 77.6000, "stop_order": 2},
-            {"id": 3, "name": "Airport", "latitude": 12.9500, "longitude": 77.6500, "stop_order": 3},
-            {"id": 4, "name": "Mall Junction", "latitude": 12.9900, "longitude": 77.5800, "stop_order": 4},
-            {"id": 5, "name": "Tech Park", "latitude": 12.9600, "longitude": 77.5700, "stop_order": 5},
-            {"id": 6, "name": "University", "latitude": 12.9400, "longitude": 77.6200, "stop_order": 6}
-        ]
-        
-        return stops
-        
-    except Exception as e:
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Error fetching stops: {str(e)}"
-        )
@@ -1,30 +1,43 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
-from typing import List
+from fastapi import APIRouter, HTTPException, Response, status
+from sqlalchemy.orm import joinedload
+from typing import List, Optional
 
-from ..database import get_db
-from ..dependencies import get_current_user, get_admin_user, get_current_active_user
+from ..dependencies import AdminUser, DbSession
 from ..schemas import User, UserUpdate, Driver, DriverUpdate
 from ..models.user import User as UserModel, Driver as DriverModel
 
 router = APIRouter(prefix="/users", tags=["users"])
 
 @router.get("/", response_model=List[User])
-async def get_users(
+def get_users(
+    response: Response,
+    db: DbSession,
+    current_user: AdminUser,
     skip: int = 0,
     limit: int = 100,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_admin_user)
+    after_id: Optional[int] = None
 ):
-    """Get all users (admin only)"""
-    users = db.query(UserModel).offset(skip).limit(limit).all()
+    """Get all users (admin only)
+
+    Pass the X-Next-After-Id header of a page as after_id to fetch the next one
+    with an index seek instead of an OFFSET scan.
+    """
+    query = db.query(UserModel).order_by(UserModel.id)
+    if after_id is not None:
+        query = query.filter(UserModel.id > after_id)
+    else:
+        query = query.offset(skip)
+    users = query.limit(limit).all()
+    
+    if limit and len(users) == limit:
+        response.headers["X-Next-After-Id"] = str(users[-1].id)
     return users
 
 @router.get("/{user_id}", response_model=User)
-async def get_user(
+def get_user(
     user_id: int,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_admin_user)
+    db: DbSession,
+    current_user: AdminUser
 ):
     """Get user by ID (admin only)"""
     user = db.query(UserModel).filter(UserModel.id == user_id).first()
@@ -33,11 +46,11 @@ async def get_user(
     return user
 
 @router.put("/{user_id}", response_model=User)
-async def update_user(
+def update_user(
     user_id: int,
     user_update: UserUpdate,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_admin_user)
+    db: DbSession,
+    current_user: AdminUser
 ):
     """Update user (admin only)"""
     user = db.query(UserModel).filter(UserModel.id == user_id).first()
@@ -45,7 +58,7 @@ async def update_user(
         raise HTTPException(status_code=404, detail="User not found")
     
     # Update only provided fields
-    for field, value in user_update.dict(exclude_unset=True).items():
+    for field, value in user_update.model_dump(exclude_unset=True).items():
         setattr(user, field, value)
     
     db.commit()
@@ -53,10 +66,10 @@ async def update_user(
     return user
 
 @router.delete("/{user_id}")
-async def delete_user(
+def delete_user(
     user_id: int,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_admin_user)
+    db: DbSession,
+    current_user: AdminUser
 ):
     """Deactivate user (admin only)"""
     user = db.query(UserModel).filter(UserModel.id == user_id).first()
@@ -69,21 +82,31 @@ async def delete_user(
     return {"message": "User deactivated successfully"}
 
 @router.get("/drivers/", response_model=List[Driver])
-async def get_drivers(
+def get_drivers(
+    response: Response,
+    db: DbSession,
+    current_user: AdminUser,
     skip: int = 0,
     limit: int = 100,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_admin_user)
+    after_id: Optional[int] = None
 ):
-    """Get all drivers (admin only)"""
-    drivers = db.query(DriverModel).offset(skip).limit(limit).all()
+    """Get all drivers (admin only); after_id pages the same way as get_users"""
+    query = db.query(DriverModel).options(joinedload(DriverModel.user)).order_by(DriverModel.id)
+    if after_id is not None:
+        query = query.filter(DriverModel.id > after_id)
+    else:
+        query = query.offset(skip)
+    drivers = query.limit(limit).all()
+    
+    if limit and len(drivers) == limit:
+        response.headers["X-Next-After-Id"] = str(drivers[-1].id)
     return drivers
 
 @router.get("/drivers/{driver_id}", response_model=Driver)
-async def get_driver(
+def get_driver(
     driver_id: int,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_admin_user)
+    db: DbSession,
+    current_user: AdminUser
 ):
     """Get driver by ID (admin only)"""
     driver = db.query(DriverModel).filter(DriverModel.id == driver_id).first()
@@ -92,11 +115,11 @@ async def get_driver(
     return driver
 
 @router.put("/drivers/{driver_id}", response_model=Driver)
-async def update_driver(
+def update_driver(
     driver_id: int,
     driver_update: DriverUpdate,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_admin_user)
+    db: DbSession,
+    current_user: AdminUser
 ):
     """Update driver (admin only)"""
     driver = db.query(DriverModel).filter(DriverModel.id == driver_id).first()
@@ -104,7 +127,7 @@ async def update_driver(
         raise HTTPException(status_code=404, detail="Driver not found")
     
     # Update only provided fields
-    for field, value in driver_update.dict(exclude_unset=True).items():
+    for field, value in driver_update.model_dump(exclude_unset=True).items():
         setattr(driver, field, value)
     
     db.commit()
@@ -112,10 +135,10 @@ async def update_driver(
     return driver
 
 @router.delete("/drivers/{driver_id}")
-async def delete_driver(
+def delete_driver(
     driver_id: int,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_admin_user)
+    db: DbSession,
+    current_user: AdminUser
 ):
     """Deactivate driver (admin only)"""
     driver = db.query(DriverModel).filter(DriverModel.id == driver_id).first()
@@ -1,6 +1,8 @@
-from pydantic import BaseModel, EmailStr, field_validator
+from pydantic import BaseModel, ConfigDict, EmailStr, Field, field_validator, model_validator
 from typing import Optional, List, Union
-from datetime import datetime, date
+from typing_extensions import Annotated
+from datetime import datetime, date, timezone
+from itertools import accumulate
 from enum import Enum
 
 class UserRole(str, Enum):
@@ -30,8 +32,23 @@ class User(UserBase):
     created_at: datetime
     updated_at: Optional[datetime] = None
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
+
+def parse_license_expiry(v):
+    """License expiry as a datetime; a bare YYYY-MM-DD date means midnight"""
+    if isinstance(v, str):
+        try:
+            # Covers both YYYY-MM-DD and ISO datetimes, parsed in C
+            return datetime.fromisoformat(v)
+        except ValueError:
+            try:
+                # Non-padded dates such as 2030-1-5
+                return datetime.strptime(v, '%Y-%m-%d')
+            except ValueError:
+                raise ValueError('Invalid date format. Expected YYYY-MM-DD or ISO datetime format')
+    elif isinstance(v, date):
+        return datetime.combine(v, datetime.min.time())
+    return v
 
 # Driver specific schemas
 class DriverBase(BaseModel):
@@ -39,54 +56,31 @@ class DriverBase(BaseModel):
     license_expiry: Union[datetime, date, str]
     experience_years: int
     
-    @field_validator('license_expiry')
+    @field_validator('license_expiry', mode='before')
     @classmethod
     def parse_license_expiry(cls, v):
-        if isinstance(v, str):
-            try:
-                # Try parsing as date first (YYYY-MM-DD)
-                parsed_date = datetime.strptime(v, '%Y-%m-%d').date()
-                # Convert to datetime at midnight
-                return datetime.combine(parsed_date, datetime.min.time())
-            except ValueError:
-                try:
-                    # Try parsing as datetime
-                    return datetime.fromisoformat(v)
-                except ValueError:
-                    raise ValueError('Invalid date format. Expected YYYY-MM-DD or ISO datetime format')
-        elif isinstance(v, date):
-            return datetime.combine(v, datetime.min.time())
-        return v
+        return parse_license_expiry(v)
 
 class DriverCreate(DriverBase):
     user_id: int
 
+class CombinedDriverCreate(DriverBase):
+    """User account and driver profile fields submitted together by an admin"""
+    email: EmailStr
+    full_name: str
+    phone: Optional[str] = None
+    password: str
+
 class DriverUpdate(BaseModel):
     license_number: Optional[str] = None
     license_expiry: Optional[Union[datetime, date, str]] = None
     experience_years: Optional[int] = None
     is_active: Optional[bool] = None
     
-    @field_validator('license_expiry')
+    @field_validator('license_expiry', mode='before')
     @classmethod
     def parse_license_expiry(cls, v):
-        if v is None:
-            return v
-        if isinstance(v, str):
-            try:
-                # Try parsing as date first (YYYY-MM-DD)
-                parsed_date = datetime.strptime(v, '%Y-%m-%d').date()
-                # Convert to datetime at midnight
-                return datetime.combine(parsed_date, datetime.min.time())
-            except ValueError:
-                try:
-                    # Try parsing as datetime
-                    return datetime.fromisoformat(v)
-                except ValueError:
-                    raise ValueError('Invalid date format. Expected YYYY-MM-DD or ISO datetime format')
-        elif isinstance(v, date):
-            return datetime.combine(v, datetime.min.time())
-        return v
+        return parse_license_expiry(v)
 
 class Driver(DriverBase):
     id: int
@@ -96,15 +90,22 @@ class Driver(DriverBase):
     created_at: datetime
     user: User
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 # Face recognition schemas
+# Upper bound for a base64 encoded face image (~6 MB decoded). Enough for a
+# full-resolution phone capture; anything larger is rejected before decoding.
+MAX_FACE_IMAGE_B64_LENGTH = 8_000_000
+FaceImageData = Annotated[str, Field(max_length=MAX_FACE_IMAGE_B64_LENGTH)]
+# The admin UI asks for 3-5 photos per driver; cap a single upload so the
+# request body stays bounded (images * per-image limit).
+MAX_FACE_IMAGES = 10
+
 class FaceImageUpload(BaseModel):
-    image_data: str  # Base64 encoded image
+    image_data: FaceImageData  # Base64 encoded image
     
 class FaceLoginRequest(BaseModel):
-    image_data: str  # Base64 encoded image
+    image_data: FaceImageData  # Base64 encoded image
     
 class FaceLoginResponse(BaseModel):
     access_token: str
@@ -112,6 +113,8 @@ class FaceLoginResponse(BaseModel):
     user: User
     driver: Driver
 
+    model_config = ConfigDict(from_attributes=True)
+
 class FaceQualityResponse(BaseModel):
     is_valid: bool
     face_count: int
@@ -142,8 +145,7 @@ class Bus(BusBase):
     created_at: datetime
     updated_at: Optional[datetime] = None
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 # Route Management Schemas
 class RouteStopBase(BaseModel):
@@ -161,8 +163,7 @@ class RouteStop(RouteStopBase):
     route_id: int
     created_at: datetime
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 class RouteBase(BaseModel):
     route_name: str
@@ -195,8 +196,7 @@ class Route(RouteBase):
     bus: Bus
     stops: List[RouteStop] = []
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 # Bus Assignment Schema (removed - driver assignment only through route creation)
 # class BusAssignment(BaseModel):
@@ -207,8 +207,7 @@ class Route(RouteBase):
 class BusWithRoutes(Bus):
     routes: List[Route] = []
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 # QR Code Scan Response
 class QRScanResponse(BaseModel):
@@ -229,6 +228,29 @@ class GPSLocationCreate(BaseModel):
     latitude: float
     longitude: float
     bus_id: Optional[int] = None
+    timestamp: Optional[datetime] = None  # Device time; defaults to server time
+
+class GPSLocationBatch(BaseModel):
+    locations: List[GPSLocationCreate] = Field(..., min_length=1, max_length=1000)
+    # Optional compact timestamps: epoch ms of the first fix plus per-fix deltas
+    # from the previous fix (the first delta is normally 0)
+    base_timestamp_ms: Optional[int] = Field(None, ge=0)
+    timestamp_deltas_ms: Optional[List[int]] = None
+
+    @model_validator(mode='after')
+    def decode_timestamp_deltas(self):
+        if self.timestamp_deltas_ms is None:
+            return self
+        if self.base_timestamp_ms is None:
+            raise ValueError('base_timestamp_ms is required with timestamp_deltas_ms')
+        if len(self.timestamp_deltas_ms) != len(self.locations):
+            raise ValueError('timestamp_deltas_ms must have one entry per location')
+        
+        for location, offset_ms in zip(self.locations, accumulate(self.timestamp_deltas_ms)):
+            location.timestamp = datetime.fromtimestamp(
+                (self.base_timestamp_ms + offset_ms) / 1000, tz=timezone.utc
+            )
+        return self
 
 # Authentication schemas
 class Token(BaseModel):
@@ -236,6 +258,8 @@ class Token(BaseModel):
     token_type: str
     user: User
 
+    model_config = ConfigDict(from_attributes=True)
+
 class TokenData(BaseModel):
     email: Optional[str] = None
 
@@ -253,7 +277,7 @@ class ChangePassword(BaseModel):
 # Face recognition schemas
 class FaceUpload(BaseModel):
     driver_id: int
-    images: List[str]  # List of base64 encoded images
+    images: Annotated[List[FaceImageData], Field(min_length=1, max_length=MAX_FACE_IMAGES)]  # List of base64 encoded images
 
 class FaceRecognitionResult(BaseModel):
     success: bool
@@ -264,10 +288,8 @@ class FaceRecognitionResult(BaseModel):
 # Ticket Management Schemas
 class TicketCreate(BaseModel):
     bus_id: int
-    bus_number: str
-    route_name: str
-    source_stop: str
-    destination_stop: str
+    source_stop_id: int
+    destination_stop_id: int
 
 class TicketResponse(BaseModel):
     id: str
@@ -278,9 +300,9 @@ class TicketResponse(BaseModel):
     destination_stop: str
     qr_code: str
     one_time_code: str
-    expires_at: str
+    expires_at: datetime
     status: str
-    created_at: str
+    created_at: datetime
+    user_id: int
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
@@ -6,7 +6,7 @@ from .mock_face_recognition_service import face_service
 
 class AuthService:
     
-    def create_user(self, db: Session, user: UserCreate):
+    def create_user(self, db: Session, user: UserCreate, commit: bool = True):
         """Create a new user"""
         from ..models.user import User
         
@@ -19,11 +19,15 @@ class AuthService:
             role=user.role.value
         )
         db.add(db_user)
-        db.commit()
-        db.refresh(db_user)
+        if commit:
+            db.commit()
+            db.refresh(db_user)
+        else:
+            # Caller owns the transaction; flush to assign the primary key
+            db.flush()
         return db_user
     
-    def create_driver(self, db: Session, driver: DriverCreate):
+    def create_driver(self, db: Session, driver: DriverCreate, commit: bool = True):
         """Create a new driver profile"""
         from ..models.user import Driver
         
@@ -34,8 +38,12 @@ class AuthService:
             experience_years=driver.experience_years
         )
         db.add(db_driver)
-        db.commit()
-        db.refresh(db_driver)
+        if commit:
+            db.commit()
+            db.refresh(db_driver)
+        else:
+            # Caller owns the transaction; flush to assign the primary key
+            db.flush()
         return db_driver
     
     def login_user(self, db: Session, email: str, password: str):
@@ -1,13 +1,55 @@
-from sqlalchemy.orm import Session
-from typing import List, Optional
+from sqlalchemy import delete, exists, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, joinedload, selectinload
+from typing import Iterator, List, Optional
 from datetime import time, datetime
-from ..models.user import Bus, Route, Driver, GPSTracking, RouteStop
+from ..models.user import Bus, Route, Driver, RouteStop
 from ..schemas import BusCreate, BusUpdate, RouteCreate, RouteUpdate, GPSLocationCreate
 from .qr_service import qr_service
+from .gps_writer import gps_writer, insert_gps_rows
+from .cache_service import cache_service
+from ..utils.etag import bump_etag_version
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Public QR scan responses change only when a bus or its routes change
+QR_CACHE_TTL_SECONDS = 60
+
+# Map visualization (stops + ORS geometry) changes only when its route is edited;
+# the TTL just bounds how long a geometry computed while ORS was down is served
+VISUALIZATION_CACHE_TTL_SECONDS = 3600
+
+def route_visualization_key(route_id: int) -> str:
+    return f"viz:route:{route_id}"
+
+# Each driver's active-route stop coordinates, used by every location ping's proximity check
+DRIVER_STOPS_TTL_SECONDS = 30
+
+def driver_stops_key(driver_id: int) -> str:
+    return f"stops:driver:{driver_id}"
+
+# Prefix for the passenger router's cached stop and route tables
+PASSENGER_CACHE_PREFIX = "passenger:"
+
+def route_response_options() -> tuple:
+    """
+    Eager loads for the Route response schema. The bus is a many-to-one join;
+    stops use a separate IN query so the bus row (with its base64 QR image) isn't
+    repeated once per stop. The driver isn't part of the schema, so it isn't loaded.
+    """
+    return (joinedload(Route.bus), selectinload(Route.stops))
+
+def invalidate_bus_caches(bus_id: Optional[int] = None, route_id: Optional[int] = None):
+    """Drop cached QR scan responses for one bus (or all buses), a route's map data, driver and passenger stop/route tables, and expire listing ETags"""
+    cache_service.delete_prefix(f"qr:{bus_id}:" if bus_id is not None else "qr:")
+    # Any route write can change which route (and stops) a driver is on
+    cache_service.delete_prefix("stops:driver:")
+    cache_service.delete_prefix(PASSENGER_CACHE_PREFIX)
+    if route_id is not None:
+        cache_service.delete(route_visualization_key(route_id))
+    bump_etag_version()
+
 class BusService:
     def __init__(self):
         pass
@@ -57,64 +99,75 @@ class BusService:
         """Get all active buses with pagination"""
         return db.query(Bus).filter(Bus.is_active == True).offset(skip).limit(limit).all()
     
+    def iter_buses(self, db: Session, skip: int = 0, limit: int = 100, batch_size: int = 100) -> Iterator[Bus]:
+        """Stream active buses from a server-side cursor, batch_size rows at a time"""
+        return db.execute(
+            select(Bus).where(Bus.is_active == True).order_by(Bus.id).offset(skip).limit(limit)
+            .execution_options(yield_per=batch_size)
+        ).scalars()
+    
     def get_bus_by_id(self, db: Session, bus_id: int) -> Optional[Bus]:
-        """Get bus by ID"""
-        return db.query(Bus).filter(Bus.id == bus_id).first()
+        """Get bus by ID with its routes and their stops loaded up front"""
+        return db.query(Bus).options(
+            selectinload(Bus.routes).selectinload(Route.stops)
+        ).filter(Bus.id == bus_id).first()
     
     def get_bus_by_number(self, db: Session, bus_number: str) -> Optional[Bus]:
         """Get bus by bus number"""
         return db.query(Bus).filter(Bus.bus_number == bus_number).first()
     
     def update_bus(self, db: Session, bus_id: int, bus_update: BusUpdate) -> Optional[Bus]:
-        """Update bus information"""
+        """Update bus information with a single UPDATE ... RETURNING"""
         try:
-            db_bus = db.query(Bus).filter(Bus.id == bus_id).first()
+            update_data = bus_update.model_dump(exclude_unset=True)
+            if not update_data:
+                return db.get(Bus, bus_id)
+            
+            db_bus = db.execute(
+                update(Bus).where(Bus.id == bus_id).values(**update_data).returning(Bus)
+            ).scalar_one_or_none()
             if not db_bus:
+                db.rollback()
                 return None
             
-            update_data = bus_update.dict(exclude_unset=True)
-            
-            # Check if bus number is being updated and doesn't conflict
-            if "bus_number" in update_data:
-                existing_bus = db.query(Bus).filter(
-                    Bus.bus_number == update_data["bus_number"],
-                    Bus.id != bus_id
-                ).first()
-                if existing_bus:
-                    raise ValueError(f"Bus number {update_data['bus_number']} already exists")
-            
-            for field, value in update_data.items():
-                setattr(db_bus, field, value)
-            
             db.commit()
-            db.refresh(db_bus)
+            invalidate_bus_caches(bus_id)
             
             logger.info(f"Updated bus {bus_id}")
             return db_bus
             
+        except IntegrityError as e:
+            db.rollback()
+            # bus_number is the only unique column a bus update can touch
+            if "bus_number" in update_data:
+                raise ValueError(f"Bus number {update_data['bus_number']} already exists")
+            logger.error(f"Error updating bus {bus_id}: {str(e)}")
+            raise
         except Exception as e:
             db.rollback()
             logger.error(f"Error updating bus {bus_id}: {str(e)}")
             raise
     
     def delete_bus(self, db: Session, bus_id: int) -> bool:
-        """Delete bus permanently"""
+        """Delete bus permanently, refusing while it still has routes"""
         try:
-            db_bus = db.query(Bus).filter(Bus.id == bus_id).first()
-            if not db_bus:
-                return False
-            
-            # Check if bus has active routes
-            active_routes = db.query(Route).filter(
-                Route.bus_id == bus_id
-            ).count()
-            
-            if active_routes > 0:
+            # Delete only if no route references the bus; RETURNING tells us whether it happened
+            deleted_id = db.execute(
+                delete(Bus).where(
+                    Bus.id == bus_id,
+                    ~exists().where(Route.bus_id == Bus.id)
+                ).returning(Bus.id)
+            ).scalar_one_or_none()
+            
+            if deleted_id is None:
+                db.rollback()
+                # Only the failure path pays for telling "missing" apart from "has routes"
+                if db.get(Bus, bus_id) is None:
+                    return False
                 raise ValueError("Cannot delete bus with existing routes. Please delete routes first.")
             
-            # Hard delete the bus
-            db.delete(db_bus)
             db.commit()
+            invalidate_bus_caches(bus_id)
             
             logger.info(f"Deleted bus {bus_id}")
             return True
@@ -154,30 +207,47 @@ class BusService:
             raise
 
     def record_gps_location(self, db: Session, location_data: GPSLocationCreate, driver_id: int) -> None:
-        """Record GPS location for a driver"""
+        """Record GPS location for a driver (queued for the next batched insert)"""
+        gps_writer.enqueue(
+            driver_id=driver_id,
+            latitude=location_data.latitude,
+            longitude=location_data.longitude,
+            bus_id=location_data.bus_id,
+            timestamp=location_data.timestamp
+        )
+
+    def record_gps_locations(self, db: Session, locations: List[GPSLocationCreate], driver_id: int) -> int:
+        """Record a batch of GPS locations for a driver with a single bulk insert and commit"""
         try:
-            # Get current route for the driver
-            current_route = db.query(Route).filter(
+            # Resolve the driver's route once for the whole batch
+            current_route = db.query(Route.id).filter(
                 Route.driver_id == driver_id,
                 Route.is_active == True
             ).first()
-            
-            gps_record = GPSTracking(
-                latitude=location_data.latitude,
-                longitude=location_data.longitude,
-                driver_id=driver_id,
-                bus_id=location_data.bus_id,
-                route_id=current_route.id if current_route else None
-            )
-            
-            db.add(gps_record)
+            route_id = current_route.id if current_route else None
+            received_at = datetime.utcnow()
+            
+            rows = [
+                {
+                    "latitude": location.latitude,
+                    "longitude": location.longitude,
+                    "driver_id": driver_id,
+                    "bus_id": location.bus_id,
+                    "route_id": route_id,
+                    "timestamp": location.timestamp or received_at
+                }
+                for location in locations
+            ]
+            
+            insert_gps_rows(db, rows)
             db.commit()
             
-            logger.info(f"Recorded GPS location for driver {driver_id}")
+            logger.info(f"Recorded {len(rows)} GPS locations for driver {driver_id}")
+            return len(rows)
             
         except Exception as e:
             db.rollback()
-            logger.error(f"Error recording GPS location: {str(e)}")
+            logger.error(f"Error recording GPS locations: {str(e)}")
             raise
 
 class RouteService:
@@ -186,14 +256,15 @@ class RouteService:
     
     def get_available_drivers(self, db: Session) -> List[Driver]:
         """Get drivers that are not assigned to any active route"""
-        assigned_driver_ids = db.query(Route.driver_id).filter(
-            Route.driver_id.isnot(None),
+        has_active_route = exists().where(
+            Route.driver_id == Driver.id,
             Route.is_active == True
-        ).subquery()
+        )
         
-        return db.query(Driver).filter(
+        # User is serialized with each driver, so load it in the same query
+        return db.query(Driver).options(joinedload(Driver.user)).filter(
             Driver.is_active == True,
-            ~Driver.id.in_(assigned_driver_ids)
+            ~has_active_route
         ).all()
     
     def create_route(self, db: Session, route_data: RouteCreate) -> Route:
@@ -250,14 +321,10 @@ class RouteService:
                     db.add(db_stop)
             
             db.commit()
+            invalidate_bus_caches(db_route.bus_id)
             
             # Fetch the created route with relationships loaded
-            from sqlalchemy.orm import joinedload
-            created_route = db.query(Route).options(
-                joinedload(Route.bus),
-                joinedload(Route.driver),
-                joinedload(Route.stops)
-            ).filter(Route.id == db_route.id).first()
+            created_route = db.query(Route).options(*route_response_options()).filter(Route.id == db_route.id).first()
             
             logger.info(f"Created route: {route_data.route_name} with {len(route_data.stops) if route_data.stops else 0} stops")
             return created_route
@@ -267,13 +334,11 @@ class RouteService:
             logger.error(f"Error creating route: {str(e)}")
             raise
     
-    def get_routes(self, db: Session, skip: int = 0, limit: int = 100) -> List[Route]:
-        """Get all active routes with pagination, automatically clean up expired routes"""
+    def deactivate_expired_routes(self, db: Session) -> int:
+        """Deactivate active routes older than 1 day, returning how many were changed"""
         from datetime import datetime, timedelta
-        from sqlalchemy.orm import joinedload
         
         try:
-            # Clean up expired routes (older than 1 day)
             cutoff_date = datetime.utcnow() - timedelta(days=1)
             expired_routes = db.query(Route).filter(
                 Route.created_at < cutoff_date,
@@ -284,65 +349,74 @@ class RouteService:
                 for route in expired_routes:
                     route.is_active = False
                 db.commit()
+                invalidate_bus_caches()
                 logger.info(f"Deactivated {len(expired_routes)} expired routes")
             
+            return len(expired_routes)
+            
+        except Exception as e:
+            db.rollback()
+            logger.error(f"Error deactivating expired routes: {str(e)}")
+            return 0
+    
+    def get_routes(self, db: Session, skip: int = 0, limit: int = 100) -> List[Route]:
+        """Get all active routes with pagination (call deactivate_expired_routes first)"""
+        try:
             # Return only active routes with eagerly loaded relationships
-            return db.query(Route).options(
-                joinedload(Route.bus),
-                joinedload(Route.driver),
-                joinedload(Route.stops)
-            ).filter(Route.is_active == True).offset(skip).limit(limit).all()
+            return db.query(Route).options(*route_response_options()).filter(
+                Route.is_active == True
+            ).offset(skip).limit(limit).all()
             
         except Exception as e:
             db.rollback()
             logger.error(f"Error fetching routes: {str(e)}")
             return []
     
+    def iter_routes(self, db: Session, skip: int = 0, limit: int = 100, batch_size: int = 100) -> Iterator[Route]:
+        """Stream active routes from a server-side cursor (call deactivate_expired_routes first)"""
+        # selectinload rather than joinedload: joined collection loading can't be combined with yield_per
+        return db.execute(
+            select(Route).options(
+                selectinload(Route.bus),
+                selectinload(Route.stops)
+            ).where(Route.is_active == True).order_by(Route.id).offset(skip).limit(limit)
+            .execution_options(yield_per=batch_size)
+        ).scalars()
+    
     def get_route_by_id(self, db: Session, route_id: int) -> Optional[Route]:
         """Get route by ID with eagerly loaded relationships"""
-        from sqlalchemy.orm import joinedload
-        return db.query(Route).options(
-            joinedload(Route.bus),
-            joinedload(Route.driver),
-            joinedload(Route.stops)
-        ).filter(Route.id == route_id).first()
+        return db.query(Route).options(*route_response_options()).filter(Route.id == route_id).first()
     
     def get_routes_by_bus(self, db: Session, bus_id: int) -> List[Route]:
         """Get all routes for a specific bus with eagerly loaded relationships"""
-        from sqlalchemy.orm import joinedload
-        return db.query(Route).options(
-            joinedload(Route.bus),
-            joinedload(Route.driver),
-            joinedload(Route.stops)
-        ).filter(Route.bus_id == bus_id).all()
+        return db.query(Route).options(*route_response_options()).filter(Route.bus_id == bus_id).all()
     
-    def get_route_stops(self, db: Session, route_id: int) -> List[RouteStop]:
-        """Get all stops for a specific route ordered by stop_order"""
-        return db.query(RouteStop).filter(
-            RouteStop.route_id == route_id
-        ).order_by(RouteStop.stop_order).all()
+    def get_route_stops(self, db: Session, route_id: int) -> Optional[List[RouteStop]]:
+        """Get all stops for a specific route ordered by stop_order, or None if the route does not exist"""
+        route = db.query(Route).options(selectinload(Route.stops)).filter(Route.id == route_id).first()
+        return route.stops if route else None
     
     def update_route(self, db: Session, route_id: int, route_update: RouteUpdate) -> Optional[Route]:
-        """Update route information"""
-        from sqlalchemy.orm import joinedload
+        """Update route information with a single UPDATE ... RETURNING"""
         try:
-            db_route = db.query(Route).filter(Route.id == route_id).first()
-            if not db_route:
+            update_data = route_update.model_dump(exclude_unset=True)
+            
+            # Load the relationships the response needs alongside the returned row
+            loaders = (selectinload(Route.bus), selectinload(Route.stops))
+            if not update_data:
+                return db.execute(select(Route).options(*loaders).where(Route.id == route_id)).scalar_one_or_none()
+            
+            updated_route = db.execute(
+                select(Route).from_statement(
+                    update(Route).where(Route.id == route_id).values(**update_data).returning(Route)
+                ).options(*loaders)
+            ).scalar_one_or_none()
+            if not updated_route:
+                db.rollback()
                 return None
             
-            update_data = route_update.dict(exclude_unset=True)
-            
-            for field, value in update_data.items():
-                setattr(db_route, field, value)
-            
             db.commit()
-            
-            # Fetch the updated route with relationships loaded
-            updated_route = db.query(Route).options(
-                joinedload(Route.bus),
-                joinedload(Route.driver),
-                joinedload(Route.stops)
-            ).filter(Route.id == route_id).first()
+            invalidate_bus_caches(updated_route.bus_id, route_id)
             
             logger.info(f"Updated route {route_id}")
             return updated_route
@@ -353,15 +427,20 @@ class RouteService:
             raise
     
     def delete_route(self, db: Session, route_id: int) -> bool:
-        """Delete route permanently"""
+        """Delete route and its stops permanently"""
         try:
-            db_route = db.query(Route).filter(Route.id == route_id).first()
-            if not db_route:
+            # Core DELETE bypasses the ORM cascade, so remove the stops explicitly
+            db.execute(delete(RouteStop).where(RouteStop.route_id == route_id))
+            bus_id = db.execute(
+                delete(Route).where(Route.id == route_id).returning(Route.bus_id)
+            ).scalar_one_or_none()
+            
+            if bus_id is None:
+                db.rollback()
                 return False
             
-            # Hard delete the route
-            db.delete(db_route)
             db.commit()
+            invalidate_bus_caches(bus_id, route_id)
             
             logger.info(f"Deleted route {route_id}")
             return True
@@ -371,6 +450,13 @@ class RouteService:
             logger.error(f"Error deleting route {route_id}: {str(e)}")
             raise
     
+    def get_driver_active_route_with_stops(self, db: Session, driver_id: int) -> Optional[Route]:
+        """Get the active route for a driver with its ordered stops, in a single joined query"""
+        return db.query(Route).options(joinedload(Route.stops)).filter(
+            Route.driver_id == driver_id,
+            Route.is_active == True
+        ).first()
+    
     def get_driver_active_route(self, db: Session, driver_id: int) -> Optional[Route]:
         """Get the active route for a specific driver"""
         try:
@@ -2,12 +2,15 @@
 Bus tracking service for driver location updates and proximity alerts
 Handles GPS updates, distance calculations, and proximity notifications
 """
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, List, Tuple
+import numpy as np
 from sqlalchemy.orm import Session
-from geopy.distance import geodesic
-from datetime import datetime
-from ..models.user import GPSTracking, Route, RouteStop, Driver
+from ..models.user import GPSTracking
 from .geocoding import geocoding_service
+from .gps_writer import gps_writer, live_location_key, LIVE_LOCATION_TTL_SECONDS
+from .cache_service import cache_service
+from .bus_service import route_service, driver_stops_key, DRIVER_STOPS_TTL_SECONDS
+from ..utils.geo import haversine_km_vec
 
 class BusTrackingService:
     def __init__(self):
@@ -33,20 +36,22 @@ class BusTrackingService:
             }
         """
         try:
-            # Store GPS location in database
-            gps_record = GPSTracking(
+            # Queue GPS location for the batched writer
+            gps_writer.enqueue(
                 driver_id=driver_id,
-                bus_id=bus_id,
                 latitude=latitude,
                 longitude=longitude,
-                timestamp=datetime.utcnow()
+                bus_id=bus_id
             )
-            db.add(gps_record)
-            db.commit()
             
-            # Check for proximity alerts
-            proximity_alert = self.check_proximity_to_next_stop(db, driver_id, latitude, longitude)
-            next_stop_info = self.get_next_stop_info(db, driver_id, latitude, longitude)
+            # One nearest-stop lookup serves both the alert and the next-stop info
+            try:
+                nearest = self._nearest_stop(db, driver_id, latitude, longitude)
+            except Exception as e:
+                print(f"Error finding next stop: {e}")
+                nearest = None
+            proximity_alert = self._proximity_alert(nearest)
+            next_stop_info = self._next_stop_info(nearest)
             
             return {
                 'success': True,
@@ -62,63 +67,86 @@ class BusTrackingService:
                 'error': str(e)
             }
     
+    def _active_route_stops(self, db: Session, driver_id: int) -> Optional[Dict[str, Any]]:
+        """
+        Stops of the driver's active route as a coordinate array plus stop details,
+        cached per driver so location pings don't re-query the route
+        """
+        def load_stops():
+            active_route = route_service.get_driver_active_route_with_stops(db, driver_id)
+            if not active_route:
+                return None
+            
+            located_stops = [stop for stop in active_route.stops if stop.latitude and stop.longitude]
+            return {
+                'route_id': active_route.id,
+                'coords': np.array([(stop.latitude, stop.longitude) for stop in located_stops], dtype=np.float64).reshape(-1, 2),
+                'stops': [{
+                    'location_name': stop.location_name,
+                    'stop_order': stop.stop_order,
+                    'latitude': stop.latitude,
+                    'longitude': stop.longitude
+                } for stop in located_stops]
+            }
+        
+        return cache_service.get_or_set(driver_stops_key(driver_id), DRIVER_STOPS_TTL_SECONDS, load_stops)
+    
+    def _nearest_stop(self, db: Session, driver_id: int, 
+                      current_lat: float, current_lng: float) -> Optional[Tuple[Dict[str, Any], float]]:
+        """Closest stop on the driver's active route and its distance in meters, in one vectorized pass"""
+        route_stops = self._active_route_stops(db, driver_id)
+        if not route_stops or not route_stops['stops']:
+            return None
+        
+        coords = route_stops['coords']
+        distances = haversine_km_vec(current_lat, current_lng, coords[:, 0], coords[:, 1]) * 1000
+        closest = int(np.argmin(distances))
+        return route_stops['stops'][closest], float(distances[closest])
+    
+    def _proximity_alert(self, nearest: Optional[Tuple[Dict[str, Any], float]]) -> Optional[Dict[str, Any]]:
+        if not nearest:
+            return None
+        
+        next_stop, distance = nearest
+        if distance > self.proximity_threshold:
+            return None
+        
+        return {
+            'alert': True,
+            'message': f"Approaching {next_stop['location_name']}",
+            'stop_name': next_stop['location_name'],
+            'distance_meters': round(distance, 1),
+            'stop_order': next_stop['stop_order'],
+            'trigger_buzzer': True,
+            'notification_type': 'proximity_alert'
+        }
+    
+    def _next_stop_info(self, nearest: Optional[Tuple[Dict[str, Any], float]]) -> Optional[Dict[str, Any]]:
+        if not nearest:
+            return None
+        
+        next_stop, distance = nearest
+        return {
+            'stop_name': next_stop['location_name'],
+            'stop_order': next_stop['stop_order'],
+            'distance_meters': round(distance, 1),
+            'distance_km': round(distance / 1000, 2),
+            'latitude': next_stop['latitude'],
+            'longitude': next_stop['longitude'],
+            'within_proximity': distance <= self.proximity_threshold
+        }
+    
     def check_proximity_to_next_stop(self, db: Session, driver_id: int, 
                                    current_lat: float, current_lng: float) -> Optional[Dict[str, Any]]:
         """
-        Check distance to next stop using geopy.distance
+        Check distance to the closest stop on the driver's active route
         Trigger buzzer/notification if within 100m
         
         Returns:
             Alert dict if within threshold, None otherwise
         """
         try:
-            # Get driver's active route
-            driver = db.query(Driver).filter(Driver.id == driver_id).first()
-            if not driver:
-                return None
-            
-            # Find active route for this driver
-            active_route = db.query(Route).filter(
-                Route.driver_id == driver_id,
-                Route.is_active == True
-            ).first()
-            
-            if not active_route:
-                return None
-            
-            # Get all stops for this route
-            stops = db.query(RouteStop).filter(
-                RouteStop.route_id == active_route.id
-            ).order_by(RouteStop.stop_order).all()
-            
-            current_location = (current_lat, current_lng)
-            
-            # Find the next stop (closest unvisited stop)
-            min_distance = float('inf')
-            next_stop = None
-            
-            for stop in stops:
-                if stop.latitude and stop.longitude:
-                    stop_location = (stop.latitude, stop.longitude)
-                    distance = geodesic(current_location, stop_location).meters
-                    
-                    if distance < min_distance:
-                        min_distance = distance
-                        next_stop = stop
-            
-            # Check if within proximity threshold
-            if next_stop and min_distance <= self.proximity_threshold:
-                return {
-                    'alert': True,
-                    'message': f"Approaching {next_stop.location_name}",
-                    'stop_name': next_stop.location_name,
-                    'distance_meters': round(min_distance, 1),
-                    'stop_order': next_stop.stop_order,
-                    'trigger_buzzer': True,
-                    'notification_type': 'proximity_alert'
-                }
-            
-            return None
+            return self._proximity_alert(self._nearest_stop(db, driver_id, current_lat, current_lng))
             
         except Exception as e:
             print(f"Error checking proximity: {e}")
@@ -130,47 +158,7 @@ class BusTrackingService:
         Get information about the next stop for the driver
         """
         try:
-            # Get driver's active route
-            active_route = db.query(Route).filter(
-                Route.driver_id == driver_id,
-                Route.is_active == True
-            ).first()
-            
-            if not active_route:
-                return None
-            
-            # Get all stops for this route
-            stops = db.query(RouteStop).filter(
-                RouteStop.route_id == active_route.id
-            ).order_by(RouteStop.stop_order).all()
-            
-            current_location = (current_lat, current_lng)
-            
-            # Find the closest stop (assuming it's the next one)
-            min_distance = float('inf')
-            next_stop = None
-            
-            for stop in stops:
-                if stop.latitude and stop.longitude:
-                    stop_location = (stop.latitude, stop.longitude)
-                    distance = geodesic(current_location, stop_location).meters
-                    
-                    if distance < min_distance:
-                        min_distance = distance
-                        next_stop = stop
-            
-            if next_stop:
-                return {
-                    'stop_name': next_stop.location_name,
-                    'stop_order': next_stop.stop_order,
-                    'distance_meters': round(min_distance, 1),
-                    'distance_km': round(min_distance / 1000, 2),
-                    'latitude': next_stop.latitude,
-                    'longitude': next_stop.longitude,
-                    'within_proximity': min_distance <= self.proximity_threshold
-                }
-            
-            return None
+            return self._next_stop_info(self._nearest_stop(db, driver_id, current_lat, current_lng))
             
         except Exception as e:
             print(f"Error getting next stop info: {e}")
@@ -179,8 +167,9 @@ class BusTrackingService:
     def get_live_bus_location(self, db: Session, bus_id: int) -> Optional[Dict[str, Any]]:
         """
         Get the most recent GPS location for a bus
+        Served from the live-location cache; concurrent misses share one query
         """
-        try:
+        def load_latest_location():
             latest_location = db.query(GPSTracking).filter(
                 GPSTracking.bus_id == bus_id
             ).order_by(GPSTracking.timestamp.desc()).first()
@@ -195,6 +184,9 @@ class BusTrackingService:
                 }
             
             return None
+        
+        try:
+            return cache_service.get_or_set(live_location_key(bus_id), LIVE_LOCATION_TTL_SECONDS, load_latest_location)
             
         except Exception as e:
             print(f"Error getting live bus location: {e}")
@@ -0,0 +1,191 @@
+"""
+Batched GPS writer
+Driver pings are queued in memory and flushed by a background thread as one
+multi-row INSERT (or COPY on PostgreSQL), instead of one INSERT and commit per request
+"""
+import csv
+import io
+import logging
+import queue
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import insert, select
+from sqlalchemy.exc import DataError, IntegrityError
+from sqlalchemy.orm import Session
+
+from ..database import SessionLocal
+from ..models.user import GPSTracking, Route
+from .cache_service import cache_service
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+# Latest position per bus, written through on every ping so live views don't
+# have to wait for (or query) the batched insert
+LIVE_LOCATION_TTL_SECONDS = 5
+
+def live_location_key(bus_id: int) -> str:
+    return f"live:bus:{bus_id}"
+
+# Batches at least this large go through COPY on PostgreSQL
+COPY_MIN_ROWS = 100
+
+GPS_COLUMNS = ("driver_id", "bus_id", "route_id", "latitude", "longitude", "timestamp")
+
+def insert_gps_rows(db: Session, rows: List[Dict[str, Any]]):
+    """
+    Insert GPS rows in the session's transaction (the caller commits).
+    Large batches on PostgreSQL are streamed with COPY FROM STDIN, which skips
+    per-row statement parsing; everything else uses one executemany INSERT.
+    """
+    connection = db.connection()
+    if len(rows) < COPY_MIN_ROWS or connection.dialect.name != "postgresql":
+        db.execute(insert(GPSTracking), rows)
+        return
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        # Unquoted empty fields are NULL in COPY's csv format
+        writer.writerow(["" if row.get(column) is None else row[column] for column in GPS_COLUMNS])
+    buffer.seek(0)
+
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert(
+            f"COPY {GPSTracking.__tablename__} ({', '.join(GPS_COLUMNS)}) FROM STDIN WITH (FORMAT csv)",
+            buffer
+        )
+    finally:
+        cursor.close()
+
+class GPSWriter:
+    def __init__(self, max_batch_size: int = 500, flush_interval: float = 0.2, max_queue_size: int = 10000):
+        self.max_batch_size = max_batch_size
+        self.flush_interval = flush_interval  # seconds
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """Start the background flusher thread"""
+        if self.running:
+            return
+        self._thread = threading.Thread(target=self._run, name="gps-writer", daemon=True)
+        self._thread.start()
+        logger.info("GPS writer started")
+
+    def stop(self, timeout: float = 5.0):
+        """Flush anything still queued and stop the flusher thread"""
+        if not self.running:
+            return
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+        self._thread = None
+        logger.info("GPS writer stopped")
+
+    def enqueue(self, driver_id: int, latitude: float, longitude: float,
+                bus_id: Optional[int] = None, timestamp: Optional[datetime] = None):
+        """Queue a GPS point for the next batch insert"""
+        row = {
+            "driver_id": driver_id,
+            "bus_id": bus_id,
+            "latitude": latitude,
+            "longitude": longitude,
+            "timestamp": timestamp or datetime.utcnow()
+        }
+
+        if bus_id is not None:
+            cache_service.set(live_location_key(bus_id), {
+                "bus_id": bus_id,
+                "latitude": latitude,
+                "longitude": longitude,
+                "timestamp": row["timestamp"].isoformat(),
+                "driver_id": driver_id
+            }, LIVE_LOCATION_TTL_SECONDS)
+
+        if self.running:
+            try:
+                self._queue.put_nowait(row)
+                return
+            except queue.Full:
+                logger.warning("GPS writer queue full, writing location synchronously")
+
+        # Not started (scripts, tests) or saturated: write through
+        self._flush([row])
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                return
+
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            stopping = False
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            self._flush(batch)
+            if stopping:
+                return
+
+    def _flush(self, rows: List[Dict[str, Any]]):
+        db = SessionLocal()
+        try:
+            # Resolve each driver's active route once per batch
+            driver_ids = {row["driver_id"] for row in rows}
+            active_routes = dict(db.execute(
+                select(Route.driver_id, Route.id).where(
+                    Route.driver_id.in_(driver_ids),
+                    Route.is_active == True
+                )
+            ).all())
+            for row in rows:
+                row["route_id"] = active_routes.get(row["driver_id"])
+
+            self._insert_isolating_bad_rows(db, rows)
+        except Exception as e:
+            db.rollback()
+            logger.error(f"Error flushing {len(rows)} GPS locations: {str(e)}")
+        finally:
+            db.close()
+
+    def _insert_isolating_bad_rows(self, db: Session, rows: List[Dict[str, Any]]):
+        """
+        Insert and commit rows as one batch; if a row is rejected, bisect and retry each
+        half so a bad row (e.g. an unknown bus_id) only costs itself, not the whole batch.
+        Any other error (connection loss, pool timeout) propagates and fails the batch once.
+        """
+        try:
+            insert_gps_rows(db, rows)
+            db.commit()
+            logger.debug(f"Flushed {len(rows)} GPS locations")
+        except (IntegrityError, DataError) as e:
+            db.rollback()
+            if len(rows) == 1:
+                logger.error(f"Dropped GPS location {rows[0]}: {str(e)}")
+                return
+            middle = len(rows) // 2
+            self._insert_isolating_bad_rows(db, rows[:middle])
+            self._insert_isolating_bad_rows(db, rows[middle:])
+
+# Global instance
+gps_writer = GPSWriter()
@@ -2,8 +2,11 @@ from typing import List, Dict, Any, Optional, Tuple
 import openrouteservice as ors
 from geopy.geocoders import Nominatim
 from geopy.distance import geodesic
-from sqlalchemy.orm import Session
-from ..models.user import Route, RouteStop, GPSTracking
+import numpy as np
+from sqlalchemy.orm import Session, joinedload
+from ..models.user import Route, RouteStop
+from .bus_tracking import bus_tracking_service
+from ..utils.geo import haversine_km_vec
 import os
 from dotenv import load_dotenv
 
@@ -146,16 +149,19 @@ class MapService:
 
     def get_route_visualization_data(self, db: Session, route_id: int) -> Optional[Dict[str, Any]]:
         """Get complete route data for map visualization"""
+        # Get route and its stops in one query
+        route = db.query(Route).options(joinedload(Route.stops)).filter(Route.id == route_id).first()
+        if not route:
+            print(f"Route {route_id} not found")
+            return None
+        
+        return self.build_visualization_from_route(db, route)
+    
+    def build_visualization_from_route(self, db: Session, route: Route) -> Optional[Dict[str, Any]]:
+        """Build map visualization data for a route whose stops are already loaded"""
+        route_id = route.id
         try:
-            # Get route and its stops
-            route = db.query(Route).filter(Route.id == route_id).first()
-            if not route:
-                print(f"Route {route_id} not found")
-                return None
-            
-            stops = db.query(RouteStop).filter(
-                RouteStop.route_id == route_id
-            ).order_by(RouteStop.stop_order).all()
+            stops = route.stops
             
             if not stops:
                 print(f"No stops found for route {route_id}")
@@ -272,53 +278,46 @@ class MapService:
     
     def get_live_bus_location(self, db: Session, bus_id: int) -> Optional[Dict[str, Any]]:
         """Get the latest GPS location for a bus"""
-        try:
-            latest_location = db.query(GPSTracking).filter(
-                GPSTracking.bus_id == bus_id
-            ).order_by(GPSTracking.timestamp.desc()).first()
-            
-            if not latest_location:
-                return None
-            
-            return {
-                'bus_id': bus_id,
-                'latitude': latest_location.latitude,
-                'longitude': latest_location.longitude,
-                'accuracy': latest_location.accuracy,
-                'speed': latest_location.speed,
-                'heading': latest_location.heading,
-                'timestamp': latest_location.timestamp.isoformat()
-            }
-            
-        except Exception as e:
-            print(f"Error getting live bus location: {e}")
+        latest_location = bus_tracking_service.get_live_bus_location(db, bus_id)
+        if not latest_location:
             return None
+        
+        # GPS fixes don't record accuracy/speed/heading; keep the keys for clients
+        return {
+            'bus_id': bus_id,
+            'latitude': latest_location['latitude'],
+            'longitude': latest_location['longitude'],
+            'accuracy': None,
+            'speed': None,
+            'heading': None,
+            'timestamp': latest_location['timestamp']
+        }
     
     def calculate_distance_to_next_stop(self, latitude: float, longitude: float, route_id: int, db: Session) -> Optional[Dict[str, Any]]:
         """Calculate distance to the next stop for a driver"""
+        # Get all stops for the route
+        stops = db.query(RouteStop).filter(
+            RouteStop.route_id == route_id
+        ).order_by(RouteStop.stop_order).all()
+        
+        return self.next_stop_from_stops(latitude, longitude, stops)
+    
+    def next_stop_from_stops(self, latitude: float, longitude: float, stops: List[RouteStop]) -> Optional[Dict[str, Any]]:
+        """Find the next stop and distance to it from an already loaded, ordered stop list"""
         try:
-            # Get all stops for the route
-            stops = db.query(RouteStop).filter(
-                RouteStop.route_id == route_id
-            ).order_by(RouteStop.stop_order).all()
-            
             if not stops:
                 return None
             
-            current_location = (latitude, longitude)
-            
-            # Find the closest stop (assuming it's the next one)
-            min_distance = float('inf')
+            # Find the closest stop (assuming it's the next one), one vectorized pass
+            located_stops = [stop for stop in stops if stop.latitude and stop.longitude]
             next_stop = None
             
-            for stop in stops:
-                if stop.latitude and stop.longitude:
-                    stop_location = (stop.latitude, stop.longitude)
-                    distance = geodesic(current_location, stop_location).kilometers
-                    
-                    if distance < min_distance:
-                        min_distance = distance
-                        next_stop = stop
+            if located_stops:
+                coords = np.array([(stop.latitude, stop.longitude) for stop in located_stops], dtype=np.float64)
+                distances = haversine_km_vec(latitude, longitude, coords[:, 0], coords[:, 1])
+                closest = int(np.argmin(distances))
+                next_stop = located_stops[closest]
+                min_distance = float(distances[closest])
             
             if next_stop:
                 # Estimate time based on average speed (40 km/h)
@@ -4,12 +4,20 @@ import base64
 from PIL import Image
 import io
 import logging
+import threading
+import time
 from typing import List, Optional, Tuple
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, contains_eager
 from ..models.user import User, Driver
 
 logger = logging.getLogger(__name__)
 
+# Length of every face encoding vector
+ENCODING_DIM = 128
+
+# Precision kept when persisting encodings (well below the match threshold)
+FACE_ENCODING_DECIMALS = 4
+
 class MockFaceRecognitionService:
     """
     Mock face recognition service for demonstration purposes.
@@ -17,6 +25,12 @@ class MockFaceRecognitionService:
     """
     def __init__(self):
         self.tolerance = 0.6
+        # Per-process matrix of every stored encoding, rebuilt lazily after
+        # invalidation (or periodically, so other workers pick up changes)
+        self.index_ttl_seconds = 60
+        self._index = None
+        self._index_built_at = 0.0
+        self._index_lock = threading.Lock()
         logger.info("Using Mock Face Recognition Service - for demo purposes only")
     
     def preprocess_image(self, image_data: bytes) -> np.ndarray:
@@ -79,9 +93,13 @@ class MockFaceRecognitionService:
         Convert face encodings to JSON string for database storage
         """
         try:
-            # Convert numpy arrays to lists for JSON serialization
-            encodings_list = [encoding.tolist() for encoding in face_encodings]
-            return json.dumps(encodings_list)
+            # Convert numpy arrays to lists for JSON serialization; matching runs in
+            # float32, so digits past FACE_ENCODING_DECIMALS only bloat the column
+            encodings_list = [
+                np.round(np.asarray(encoding, dtype=np.float64), FACE_ENCODING_DECIMALS).tolist()
+                for encoding in face_encodings
+            ]
+            return json.dumps(encodings_list, separators=(',', ':'))
         except Exception as e:
             logger.error(f"Error encoding face data: {str(e)}")
             raise ValueError("Could not encode face data")
@@ -92,7 +110,7 @@ class MockFaceRecognitionService:
         """
         try:
             encodings_list = json.loads(face_data)
-            return [np.array(encoding) for encoding in encodings_list]
+            return [np.array(encoding, dtype=np.float32) for encoding in encodings_list]
         except Exception as e:
             logger.error(f"Error decoding face data: {str(e)}")
             return []
@@ -147,6 +165,7 @@ class MockFaceRecognitionService:
             
             driver.face_encodings = encoded_face_data
             db.commit()
+            self.invalidate_encoding_index()
             
             logger.info(f"Successfully registered mock face for driver user_id: {user_id}")
             return True
@@ -156,6 +175,49 @@ class MockFaceRecognitionService:
             db.rollback()
             return False
     
+    def invalidate_encoding_index(self):
+        """
+        Drop the cached encoding index so the next login rebuilds it
+        """
+        with self._index_lock:
+            self._index = None
+    
+    def _get_encoding_index(self, db: Session) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Return (encodings, squared norms, driver ids) for all stored face encodings
+        """
+        with self._index_lock:
+            if self._index is not None and time.monotonic() - self._index_built_at < self.index_ttl_seconds:
+                return self._index
+            
+            rows = db.query(Driver.id, Driver.face_encodings).filter(
+                Driver.face_encodings.isnot(None)
+            ).all()
+            
+            encodings = []
+            owner_ids = []
+            skipped = 0
+            for driver_id, face_data in rows:
+                for encoding in self.decode_face_data(face_data):
+                    # One malformed stored encoding must not break the index for everyone
+                    if encoding.shape != (ENCODING_DIM,):
+                        skipped += 1
+                        continue
+                    encodings.append(encoding)
+                    owner_ids.append(driver_id)
+            if skipped:
+                logger.warning(f"Skipped {skipped} face encodings without shape ({ENCODING_DIM},)")
+            
+            if encodings:
+                matrix = np.asarray(encodings, dtype=np.float32)
+                self._index = (matrix, np.einsum('ij,ij->i', matrix, matrix), np.asarray(owner_ids))
+            else:
+                self._index = (np.empty((0, ENCODING_DIM), dtype=np.float32), np.empty(0, dtype=np.float32), np.empty(0, dtype=np.int64))
+            self._index_built_at = time.monotonic()
+            
+            logger.info(f"Built face encoding index with {len(encodings)} encodings from {len(rows)} drivers")
+            return self._index
+    
     def authenticate_driver_face(self, db: Session, image_data: bytes) -> Optional[Driver]:
         """
         Authenticate a driver using face recognition (mock implementation)
@@ -168,44 +230,48 @@ class MockFaceRecognitionService:
                 logger.warning("Could not extract face encoding from login image")
                 return None
             
-            # Get all active drivers with face encodings
-            drivers = db.query(Driver).join(User).filter(
+            encodings, squared_norms, owner_ids = self._get_encoding_index(db)
+            if not len(encodings):
+                logger.warning("No drivers with face encodings found")
+                return None
+            
+            # Euclidean distance to every stored encoding in one matrix product
+            query = login_encoding.astype(np.float32)
+            squared = squared_norms - 2.0 * (encodings @ query) + query @ query
+            distances = np.sqrt(np.maximum(squared, 0.0))
+            
+            # For mock, consider it a match if distance < 10 (arbitrary threshold)
+            order = np.argsort(distances)
+            order = order[distances[order] < 10.0]
+            if not len(order):
+                logger.warning("Mock face authentication failed - no matching driver found")
+                return None
+            
+            # Best distance per driver, closest first
+            best_distance = {}
+            for i in order:
+                best_distance.setdefault(int(owner_ids[i]), float(distances[i]))
+            candidate_ids = list(best_distance)
+            
+            # Activity is checked against the database, so a stale index never
+            # authenticates a deactivated driver
+            drivers = db.query(Driver).join(User).options(contains_eager(Driver.user)).filter(
+                Driver.id.in_(candidate_ids),
                 Driver.face_encodings.isnot(None),
                 Driver.is_active == True,
                 User.is_active == True,
                 User.role == "driver"
             ).all()
+            drivers_by_id = {driver.id: driver for driver in drivers}
             
-            if not drivers:
-                logger.warning("No drivers with face encodings found")
-                return None
-            
-            best_match = None
-            best_distance = float('inf')
+            for driver_id in candidate_ids:
+                best_match = drivers_by_id.get(driver_id)
+                if best_match:
+                    logger.info(f"Mock face authentication successful for driver {best_match.id} (distance: {best_distance[driver_id]})")
+                    return best_match
             
-            # Compare against each driver's face encodings
-            for driver in drivers:
-                try:
-                    stored_encodings = self.decode_face_data(driver.face_encodings)
-                    if not stored_encodings:
-                        continue
-                    
-                    is_match, distance = self.compare_faces(stored_encodings, login_encoding)
-                    
-                    if is_match and distance < best_distance:
-                        best_match = driver
-                        best_distance = distance
-                        
-                except Exception as e:
-                    logger.error(f"Error comparing with driver {driver.id}: {str(e)}")
-                    continue
-            
-            if best_match:
-                logger.info(f"Mock face authentication successful for driver {best_match.id} (distance: {best_distance})")
-                return best_match
-            else:
-                logger.warning("Mock face authentication failed - no matching driver found")
-                return None
+            logger.warning("Mock face authentication failed - no matching driver found")
+            return None
                 
         except Exception as e:
             logger.error(f"Error in face authentication: {str(e)}")
@@ -293,6 +359,7 @@ class MockFaceRecognitionService:
             
             # Commit to database
             db.commit()
+            self.invalidate_encoding_index()
             
             logger.info(f"Successfully stored {len(all_encodings)} face encodings for driver {driver_id}")
             return True
@@ -0,0 +1,47 @@
+"""
+Conditional GET helpers for rarely changing admin listings
+The ETag is a hash over a cheap per-table fingerprint (row count, max id and
+latest created/updated timestamps) plus the request path and query string
+"""
+import hashlib
+import threading
+from typing import Optional
+
+from fastapi import Request, Response
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+# Bumped on writes made by this process, so edits that land within the
+# database's timestamp resolution (one second on SQLite) still change the ETag
+_etag_version = 0
+_etag_version_lock = threading.Lock()
+
+def bump_etag_version():
+    global _etag_version
+    with _etag_version_lock:
+        _etag_version += 1
+
+def table_fingerprint(db: Session, model) -> tuple:
+    """Aggregate that changes whenever a row of model is inserted, updated or deleted"""
+    columns = [func.count(), func.max(model.id)]
+    for name in ("created_at", "updated_at"):
+        if hasattr(model, name):
+            columns.append(func.max(getattr(model, name)))
+    return tuple(db.execute(select(*columns).select_from(model)).one())
+
+def collection_etag(db: Session, request: Request, *models) -> str:
+    """Strong ETag for a listing built from the given tables"""
+    digest = hashlib.sha1(f"{request.url.path}?{request.url.query}#{_etag_version}".encode())
+    for model in models:
+        digest.update(repr(table_fingerprint(db, model)).encode())
+    return f'"{digest.hexdigest()}"'
+
+def not_modified(request: Request, response: Response, etag: str) -> Optional[Response]:
+    """Set the ETag header and return a 304 response if the client already has it"""
+    response.headers["ETag"] = etag
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        client_tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        if etag in client_tags or "*" in client_tags:
+            return Response(status_code=304, headers={"ETag": etag})
+    return None
@@ -0,0 +1,102 @@
+"""
+Great-circle distance helpers
+Scalar haversine for one pair of points and a NumPy version that measures one
+point against many in a single vectorized pass
+"""
+import math
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0
+
+# Slightly under the true ~111.19 km per degree, so bounding boxes err on the large side
+KM_PER_DEGREE = 111.0
+
+def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Distance in km between two coordinates using the Haversine formula"""
+    lat1_rad = math.radians(lat1)
+    lat2_rad = math.radians(lat2)
+    dlat = lat2_rad - lat1_rad
+    dlon = math.radians(lon2 - lon1)
+
+    a = math.sin(dlat / 2) ** 2 + math.cos(lat1_rad) * math.cos(lat2_rad) * math.sin(dlon / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(min(1.0, a)))
+
+def haversine_km_from_rad(lat1_rad: float, lon1_rad: float, cos_lat1: float,
+                          lat2_rad: float, lon2_rad: float, cos_lat2: float) -> float:
+    """Scalar haversine for points already in radians with cos(lat) precomputed"""
+    a = math.sin((lat2_rad - lat1_rad) * 0.5) ** 2 + cos_lat1 * cos_lat2 * math.sin((lon2_rad - lon1_rad) * 0.5) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(min(1.0, a)))
+
+def haversine_km_vec(lat: float, lon: float, lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+    """Distances in km from one coordinate to arrays of coordinates (degrees)"""
+    lat_rad = math.radians(lat)
+
+    # Fused in place: three array allocations instead of one per ufunc step
+    lats_rad = np.radians(lats, dtype=np.float64)
+    a = lats_rad - lat_rad
+    a *= 0.5
+    np.sin(a, out=a)
+    a *= a                                    # sin^2(dlat / 2)
+
+    t = np.radians(lons, dtype=np.float64)
+    t -= math.radians(lon)
+    t *= 0.5
+    np.sin(t, out=t)
+    t *= t                                    # sin^2(dlon / 2)
+
+    cos_lats = np.cos(lats_rad, out=lats_rad)
+    cos_lats *= math.cos(lat_rad)
+    t *= cos_lats
+    a += t
+
+    np.minimum(a, 1.0, out=a)
+    np.sqrt(a, out=a)
+    np.arcsin(a, out=a)
+    a *= 2 * EARTH_RADIUS_KM
+    return a
+
+def haversine_km_rad(lat_rad: float, lon_rad: float, lats_rad: np.ndarray, lons_rad: np.ndarray,
+                     cos_lats: np.ndarray) -> np.ndarray:
+    """
+    Distances in km from one coordinate to many, with the targets already in radians
+    and their cos(lat) precomputed (e.g. a cached stop table); only the query point is converted
+    """
+    a = lats_rad - lat_rad
+    a *= 0.5
+    np.sin(a, out=a)
+    a *= a
+
+    t = lons_rad - lon_rad
+    t *= 0.5
+    np.sin(t, out=t)
+    t *= t
+    t *= cos_lats
+    t *= math.cos(lat_rad)
+    a += t
+
+    np.minimum(a, 1.0, out=a)
+    np.sqrt(a, out=a)
+    np.arcsin(a, out=a)
+    a *= 2 * EARTH_RADIUS_KM
+    return a
+
+def cumulative_path_km(lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+    """Running distance in km along a path of coordinates (degrees); element 0 is 0.0"""
+    lats_rad = np.radians(lats, dtype=np.float64)
+    lons_rad = np.radians(lons, dtype=np.float64)
+    a = np.sin(np.diff(lats_rad) * 0.5) ** 2
+    a += np.cos(lats_rad[:-1]) * np.cos(lats_rad[1:]) * np.sin(np.diff(lons_rad) * 0.5) ** 2
+    np.minimum(a, 1.0, out=a)
+    legs = 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+    return np.concatenate(([0.0], np.cumsum(legs)))
+
+def bounding_box_mask(lat: float, lon: float, lats: np.ndarray, lons: np.ndarray, radius_km: float) -> np.ndarray:
+    """
+    Cheap degree-based prefilter: False for points that are certainly farther than radius_km.
+    Points left True still need an exact distance check.
+    """
+    mask = np.abs(lats - lat) <= radius_km / KM_PER_DEGREE
+    cos_lat = math.cos(math.radians(lat))
+    if cos_lat > 1e-6:  # longitude degrees collapse at the poles; skip that test there
+        mask &= np.abs(lons - lon) <= radius_km / (KM_PER_DEGREE * cos_lat)
+    return mask
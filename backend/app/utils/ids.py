@@ -0,0 +1,64 @@
+"""
+Ticket identifiers
+IDs are time-ordered and unique per process without a database round trip;
+they stay below 2**53 so JavaScript clients read them back exactly.
+One-time codes are drawn from the OS CSPRNG
+"""
+import hashlib
+import hmac
+import os
+import threading
+import time
+
+# Milliseconds are counted from this epoch (2024-01-01 UTC) so 41 bits last until ~2093
+_ID_EPOCH_MS = 1704067200000
+_WORKER_BITS = 4
+_SEQUENCE_BITS = 8
+_SEQUENCE_MASK = (1 << _SEQUENCE_BITS) - 1
+
+# Distinguishes worker processes started from the same image
+_worker_id = os.getpid() & ((1 << _WORKER_BITS) - 1)
+_last_ms = -1
+_sequence = 0
+_id_lock = threading.Lock()
+
+# 32 symbols without the look-alikes 0/O and 1/I; 256 is a multiple of 32, so
+# mapping each random byte through this table is unbiased
+ONE_TIME_CODE_ALPHABET = b"ABCDEFGHJKLMNPQRSTUVWXYZ23456789"
+_ONE_TIME_CODE_TABLE = bytes(ONE_TIME_CODE_ALPHABET[b % len(ONE_TIME_CODE_ALPHABET)] for b in range(256))
+
+def next_ticket_id() -> int:
+    """Monotonic 53-bit id: milliseconds | worker | per-millisecond sequence"""
+    global _last_ms, _sequence
+    with _id_lock:
+        now_ms = int(time.time() * 1000) - _ID_EPOCH_MS
+        if now_ms <= _last_ms:
+            # Same millisecond (or the clock stepped back): keep counting from the last one
+            now_ms = _last_ms
+            _sequence = (_sequence + 1) & _SEQUENCE_MASK
+            if _sequence == 0:
+                now_ms += 1  # sequence exhausted; borrow the next millisecond
+        else:
+            _sequence = 0
+        _last_ms = now_ms
+        return (now_ms << (_WORKER_BITS + _SEQUENCE_BITS)) | (_worker_id << _SEQUENCE_BITS) | _sequence
+
+def ticket_qr_digest(secret: str, ticket_id: int, bus_id: int, user_id: int) -> str:
+    """Keyed SHA-256 over the ticket's identity, truncated to 16 hex characters"""
+    message = f"{ticket_id}|{bus_id}|{user_id}".encode()
+    return hmac.new(secret.encode(), message, hashlib.sha256).hexdigest()[:16]
+
+def codes_match(secret: str, submitted: str, expected: str) -> bool:
+    """
+    Constant-time code check. Both sides are HMAC'd first, so the compared values
+    always have equal length and a mismatch reveals neither position nor length
+    """
+    key = secret.encode()
+    return hmac.compare_digest(
+        hmac.new(key, submitted.encode(), hashlib.sha256).digest(),
+        hmac.new(key, expected.encode(), hashlib.sha256).digest()
+    )
+
+def generate_one_time_code(length: int = 6) -> str:
+    """Random code of length symbols; one urandom call and a C-level byte translate"""
+    return os.urandom(length).translate(_ONE_TIME_CODE_TABLE).decode()
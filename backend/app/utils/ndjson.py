@@ -0,0 +1,27 @@
+"""
+Newline-delimited JSON streaming for large listings
+Rows are validated and serialized one at a time as the cursor yields them,
+so the full list is never materialized in memory; already-trusted dicts can
+skip the schema entirely
+"""
+from typing import Iterable, Iterator, Type
+
+import orjson
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+def iter_ndjson(rows: Iterable, schema: Type[BaseModel]) -> Iterator[bytes]:
+    for row in rows:
+        yield orjson.dumps(schema.model_validate(row).model_dump(mode="json")) + b"\n"
+
+def ndjson_response(rows: Iterable, schema: Type[BaseModel], headers: dict = None) -> StreamingResponse:
+    """Stream ORM rows as one JSON object per line"""
+    return StreamingResponse(iter_ndjson(rows, schema), media_type=NDJSON_MEDIA_TYPE, headers=headers)
+
+def dicts_ndjson_response(objects: Iterable[dict], headers: dict = None) -> StreamingResponse:
+    """Stream plain JSON-ready dicts as one object per line, without a schema pass"""
+    return StreamingResponse(
+        (orjson.dumps(obj) + b"\n" for obj in objects), media_type=NDJSON_MEDIA_TYPE, headers=headers
+    )
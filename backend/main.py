@@ -1,11 +1,14 @@
 from fastapi import FastAPI, HTTPException, Depends
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from fastapi.security import HTTPBearer
 import os
 from dotenv import load_dotenv
 
 from app.database import engine, Base
 from app.routers import auth, users, buses, tickets, sos, passenger_new
+from app.services.gps_writer import gps_writer
+from app.logging_config import start_logging, stop_logging
 
 # Load environment variables
 load_dotenv()
@@ -16,7 +19,8 @@ Base.metadata.create_all(bind=engine)
 app = FastAPI(
     title="Bus Tracking and Booking API", 
     version="1.0.0",
-    description="API for Bus Tracking and Booking System with Multi-User Authentication"
+    description="API for Bus Tracking and Booking System with Multi-User Authentication",
+    default_response_class=ORJSONResponse  # orjson serializes large list responses much faster
 )
 
 # CORS middleware
@@ -26,6 +30,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "X-Next-Cursor", "X-Next-After-Id"],  # readable by browser clients for caching/pagination
 )
 
 # Include routers
@@ -38,6 +43,16 @@ app.include_router(passenger_new.router)
 
 security = HTTPBearer()
 
+@app.on_event("startup")
+def start_background_writers():
+    start_logging()
+    gps_writer.start()
+
+@app.on_event("shutdown")
+def stop_background_writers():
+    gps_writer.stop()
+    stop_logging()
+
 @app.get("/")
 async def root():
     return {